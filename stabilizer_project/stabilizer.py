@@ -1,8 +1,32 @@
 "Contains the classes and function to manipulate stabilizer and graph states"
 import numpy as np
 import math
-from qiskit import QuantumCircuit, ClassicalRegister
-from qiskit.quantum_info import StabilizerState
+import copy
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# The operations understood by apply_circuit and simulate, an operation's integer code is its index in this tuple.
+# 'measure' (Z basis) and 'reset' (to 0) are not gates, so only simulate accepts them
+GATES = ('h','s','x','y','z','cnot','cz','measure','reset')
+
+# Layout of the gate lists returned by circuit_array, one record per operation with q2 = -1 for single qubit operations
+CIRCUIT_DTYPE = np.dtype([('gate',np.uint8),('q1',np.int32),('q2',np.int32)])
+
+# The operations of an emission protocol, an operation's code is its index in this tuple. 'emit' is an emitter emitting a
+# photon (a CNOT from the emitter onto it) and 'measure' an emitter measured after acting on an already emitted photon
+PROTOCOL_OPS = ('h','s','x','z','cnot','emit','measure')
+
+# Layout of the protocols returned by photonic_circuit_solver, one record per operation. emitter counts from 0 (emitter
+# k is qubit n_photons+k), target is the target emitter of a cnot, and unused fields are -1
+PROTOCOL_DTYPE = np.dtype([('op',np.uint8),('emitter',np.int32),('target',np.int32),('photon',np.int32),('step',np.int32)])
+
+class StabilizerError(ValueError):
+    '''
+    Raised when the stabilizers given to a Stabilizer do not describe a valid stabilizer state
+    '''
 
 class Stabilizer:
     '''
@@ -17,17 +41,35 @@ class Stabilizer:
     :param edgelist: A list of edges for a graph state. Optional
     :type edgelist: List
 
+    :param packed: Whether to store the tableau bit-packed into uint64 words (64x less memory, word-parallel row operations), defaults to False
+    :type packed: boolean, optional
+
+    :param validate: How thoroughly to check the stabilizers, 'full', 'cheap' or 'none' (see the validate method). Invalid stabilizers raise a StabilizerError. Defaults to 'full'
+    :type validate: string, optional
+
     :cvar size: The number of qubits, initial value: n
     :cvar __stabs: The stabilizers of the state, initial value: stabs (note, this is a dunder attribute, can't be directly called outside the class. There's a method to do that instead)
-    :cvar tab: The tableau of the state
-    :cvar signvector: The signvector of the state
+    :cvar tab: The tableau of the state. For packed states this is unpacked lazily from xbits and zbits, so assign to it rather than editing it in place
+    :cvar signvector: The signvector of the state. Assign to it (or to tab) rather than editing it in place, so the cached stabilizer strings are regenerated
+    :cvar packed: Whether the tableau is stored bit-packed
+    :cvar xbits: The X half of the tableau packed into uint64 words, one row per stabilizer (packed states only)
+    :cvar zbits: The Z half of the tableau packed into uint64 words, one row per stabilizer (packed states only)
     :cvar gauss: A nxn Gaussian matrix (used for empty_column calculations)
+    :cvar _dx: The X half of the destabilizers, in the same layout as the stabilizers, or None until the state is first measured
+    :cvar _dz: The Z half of the destabilizers, or None until the state is first measured
     
     '''
-    def __init__(self, n = None, stabs = None, edgelist = None):
+    def __init__(self, n = None, stabs = None, edgelist = None, packed = False, validate = 'full'):
         """Constructor method
 
         """
+        self.packed = packed
+        self._unpacked = None
+        self._version = 0
+        self._stab_version = -1
+        self._digest_version = -1
+        self._dx = None
+        self._dz = None
         if edgelist is None:    
             if n is None and stabs is None:
                 n = 2
@@ -50,60 +92,65 @@ class Stabilizer:
                 self.__stab = stabs.split(',')
             except:
                 self.__stab = stabs
-            list = self.tableau()
-            self.tab = list[0]
-            self.signvector = list[1]
-            while not self.square():
-                print("Invalid input, number of qubits not equal to number of stabilizers")
-                n = int(input("Number of Qubits "))
-                stabs = input("Stabilizers ")
-                self.size = n
-                try:
-                    self.__stab = stabs.split(',')
-                except:
-                    self.__stab = stabs
-                list = self.tableau()
-                self.tab = list[0]
-                self.signvector = list[1]
-            while self.empty_column():
-                print("Invalid input, free qubit (all stabilizers for some qubit is the identity)")
-                n = int(input("Number of Qubits "))
-                stabs = input("Stabilizers ")
-                self.size = n
-                try:
-                    self.__stab = stabs.split(',')
-                except:
-                    self.__stab = stabs
-                list = self.tableau()
-                self.tab = list[0]
-                self.signvector = list[1]
-            while not self.commuter():
-                print("Invalid Inputs, Stabilizers do not commute")
-                n = int(input("Number of Qubits "))
-                stabs = input("Stabilizers ")
-                self.size = n
-                try:
-                    self.__stab = stabs.split(',')
-                except:
-                    self.__stab = stabs
-                list = self.tableau()
-                self.tab = list[0]
-                self.signvector = list[1]
-            while not self.linear_independence():
-                print("Invalid Inputs, Stabilizers are not independant")
-                n = int(input("Number of Qubits "))
-                stabs = input("Stabilizers ")
-                self.size = n
-                try:
-                    self.__stab = stabs.split(',')
-                except:
-                    self.__stab = stabs
-                list = self.tableau()
-                self.tab = list[0]
-                self.signvector = list[1]
+            if validate != 'none' and not self.square():
+                raise StabilizerError("Invalid input, number of qubits not equal to number of stabilizers")
+            self._load_stabilizers()
+            self.validate(validate)
         else:
             self.graph_state(edgelist = edgelist)
 
+    @property
+    def tab(self):
+        """
+        The tableau of the state as an n x 2n array, X half first
+        """
+        if not self.packed:
+            return self._tab
+        if self._unpacked is None:
+            n = self.size
+            self._unpacked = np.hstack((_unpack_bits(self.xbits,n),_unpack_bits(self.zbits,n))).astype(float)
+        return self._unpacked
+
+    @tab.setter
+    def tab(self, tab):
+        self._changed()
+        self._dx = self._dz = None
+        if not self.packed:
+            self._tab = tab
+            return
+        n = tab.shape[1]//2
+        self.xbits = _pack_bits(tab[:,:n])
+        self.zbits = _pack_bits(tab[:,n:])
+
+    @property
+    def signvector(self):
+        """
+        The signs of the stabilizers, 1 for a leading minus sign
+        """
+        return self._signvector
+
+    @signvector.setter
+    def signvector(self, sign):
+        self._changed()
+        self._signvector = sign
+
+    def _changed(self):
+        """
+        Marks the tableau as modified, dropping the unpacked tab view and invalidating the cached stabilizer strings
+
+        """
+        self._unpacked = None
+        self._version += 1
+
+    def _halves(self):
+        """
+        Returns the X and Z halves of the tableau (packed words or dense columns) as views that can be edited in place
+
+        """
+        if self.packed:
+            return self.xbits, self.zbits
+        return self.tab[:,:self.size], self.tab[:,self.size:]
+
     def square(self):
         toggler = True
         for i in range(len(self.__stab)):
@@ -113,26 +160,59 @@ class Stabilizer:
                 return False
         return toggler
 
-    def commuter(self):
+    def validate(self, level = 'full', ignore_commute = False):
         """
-        Tests whether the stabilizers commute with each other
+        Checks that the tableau describes a valid stabilizer state, raising a StabilizerError if it does not
 
-        :return: Whether or not they commute
-        :rtype: boolean
+        :param level: 'full' runs every check, 'cheap' only checks for free qubits (O(n^2)), and 'none' skips validation for tableaux that are already known to be valid. Defaults to 'full'
+        :type level: string, optional
+
+        :param ignore_commute: Whether to skip the commutation check, defaults to False
+        :type ignore_commute: boolean, optional
         """
-        for i in range(self.size):
-            toggler=0
-            for j in range(i+1,self.size):
-                for k in range(self.size):
-                    if self.tab[i,k]==self.tab[j,k] and self.tab[i,k+self.size]==self.tab[j,k+self.size]:
-                        toggler = toggler
-                    elif (self.tab[i,k+self.size]==0 and self.tab[i,k]==0) or (self.tab[j,k+self.size]==0 and self.tab[j,k]==0):
-                        toggler = toggler
-                    else:
-                        toggler = toggler+1
-                if toggler%2 != 0:
+        if level not in ('full','cheap','none'):
+            raise ValueError("validate must be 'full', 'cheap' or 'none'")
+        if level == 'none':
+            return
+        if self.empty_column():
+            raise StabilizerError("Invalid input, free qubit (all stabilizers for some qubit is the identity)")
+        if level == 'cheap':
+            return
+        if not ignore_commute and not self.commuter():
+            raise StabilizerError("Invalid Inputs, Stabilizers do not commute")
+        if not self.linear_independence():
+            raise StabilizerError("Invalid Inputs, Stabilizers are not independant")
+
+    def commuter(self, pairs = False):
+        """
+        Tests whether the stabilizers commute with each other, using the symplectic inner product XZ^T + ZX^T (mod 2) of the whole tableau
+
+        :param pairs: Whether to also return the pairs of stabilizers that anticommute, defaults to False
+        :type pairs: boolean, optional
+
+        :return: Whether or not they commute, and if pairs is True, a k x 2 array of the anticommuting row pairs (i,j) with i<j
+        :rtype: boolean or tuple
+        """
+        n = self.size
+        if self.packed:
+            offending = []
+            for i in range(n-1):
+                overlap = (self.xbits[i] & self.zbits[i+1:]) ^ (self.zbits[i] & self.xbits[i+1:])
+                anti = np.flatnonzero(_popcount(overlap).sum(axis=1)%2)
+                if len(anti) != 0 and not pairs:
                     return False
-        return True
+                offending.extend([i,i+1+j] for j in anti)
+            offending = np.array(offending,dtype=int).reshape(-1,2)
+        else:
+            x = self.tab[:,:n]
+            z = self.tab[:,n:]
+            product = (x@z.T+z@x.T)%2
+            offending = np.argwhere(np.triu(product,1))
+        commute = len(offending) == 0
+        if pairs:
+            return commute, offending
+        return commute
+
     def num_qubits(self):
         """
         Returns the size of the stabilizer (the number of qubits)
@@ -156,6 +236,18 @@ class Stabilizer:
                 if edgelist[i][j]>num:
                     num = edgelist[i][j]
         self.size = num+1
+        if self.packed:
+            edges = np.array(edgelist,dtype=np.intp).reshape(-1,2)
+            rows = np.concatenate((edges[:,0],edges[:,1]))
+            cols = np.concatenate((edges[:,1],edges[:,0]))
+            diagonal = np.arange(self.size)
+            self.xbits = np.zeros((self.size,(self.size+63)//64),dtype='<u8')
+            self.zbits = np.zeros((self.size,(self.size+63)//64),dtype='<u8')
+            np.bitwise_or.at(self.xbits,(diagonal,diagonal>>6),np.uint64(1)<<(diagonal&63).astype(np.uint64))
+            np.bitwise_or.at(self.zbits,(rows,cols>>6),np.uint64(1)<<(cols&63).astype(np.uint64))
+            self._dx = self._dz = None
+            self.signvector = np.zeros(self.size)
+            return
         tab = np.zeros(2*self.size*self.size)
         tab = tab.reshape(self.size,2*self.size)
         for i in range(self.size):
@@ -176,51 +268,46 @@ class Stabilizer:
         :return: A list contained the tableau and the signvector
         :rtype: list
         """
-        tab = np.zeros(2*self.size*self.size)
-        tab = tab.reshape(self.size,2*self.size)
-        sign = np.zeros(self.size)
-        for i in range(len(self.__stab)):
-            if self.__stab[i][0]=='-':
-                sign[i]=1
-                self.__stab[i]=self.__stab[i][1:]
-            for j in range(len(self.__stab[i])):
-                if self.__stab[i][j]=='I':
-                    pass
-                elif self.__stab[i][j]=='X':
-                    tab[i,j]=1
-                elif self.__stab[i][j]=='Z':
-                    tab[i,j+self.size]=1
-                elif self.__stab[i][j]=='Y':
-                    tab[i,j]=1
-                    tab[i,j+self.size]=1
-                else:
-                    print('Invalid Stabilizer')
+        if len(self.__stab) != self.size:
+            raise StabilizerError("Invalid input, number of qubits not equal to number of stabilizers")
+        x, z, sign = _parse_paulis(self.__stab,self.size)
+        tab = np.hstack((x,z)).astype(float)
         return [tab,sign]
+
+    def _load_stabilizers(self):
+        """
+        Parses the stabilizer strings straight into the tableau (packing them directly for packed states) and signvector
+
+        """
+        if len(self.__stab) != self.size:
+            raise StabilizerError("Invalid input, number of qubits not equal to number of stabilizers")
+        x, z, self.signvector = _parse_paulis(self.__stab,self.size)
+        if self.packed:
+            self.xbits = _pack_bits(x)
+            self.zbits = _pack_bits(z)
+            self._dx = self._dz = None
+        else:
+            self.tab = np.hstack((x,z)).astype(float)
+
     def stabilizers(self):
         """
-        Returns a list of the stabilizers of the state, as per the tableau
+        Returns a list of the stabilizers of the state, as per the tableau. The strings are cached and only regenerated after the tableau changes
 
         :return: A list of operations to take a standard state to the given stabilizer state
         :rtype: list  
         
         """
-        self.__stab = []
-        for i in range(self.size):
-            str = ""
-            if self.signvector[i]==1:
-                str = str+"-"
-            for j in range(self.size):
-                if self.tab[i,j]==0 and self.tab[i,j+self.size]==0:
-                    str = str+"I"
-                elif self.tab[i,j]==1 and self.tab[i,j+self.size]==0:
-                    str = str+"X"
-                if self.tab[i,j]==0 and self.tab[i,j+self.size]==1:
-                    str = str+"Z"
-                if self.tab[i,j]==1 and self.tab[i,j+self.size]==1:
-                    str = str+"Y"
-            self.__stab.append(str)
-        return self.__stab
-    def new_stab(self,size=None,newstabs=None, ignore_commute = False):
+        if self._stab_version != self._version:
+            if self.packed:
+                x = _unpack_bits(self.xbits,self.size)
+                z = _unpack_bits(self.zbits,self.size)
+            else:
+                x = self.tab[:,:self.size].astype(np.uint8)
+                z = self.tab[:,self.size:].astype(np.uint8)
+            self.__stab = _format_paulis(x,z,self.signvector)
+            self._stab_version = self._version
+        return list(self.__stab)
+    def new_stab(self,size=None,newstabs=None, ignore_commute = False, validate = 'full'):
         """
         Resets the stabilizer and new tableau associated with it
 
@@ -229,6 +316,12 @@ class Stabilizer:
 
         :param newstabs: The new stabilizers
         :type newstabs: string or list
+
+        :param ignore_commute: Whether to skip the commutation check, defaults to False
+        :type ignore_commute: boolean, optional
+
+        :param validate: How thoroughly to check the new stabilizers, 'full', 'cheap' or 'none', defaults to 'full'
+        :type validate: string, optional
         """
         if size is None and newstabs is None:
             size = 2
@@ -249,57 +342,10 @@ class Stabilizer:
             self.__stab = newstabs.split(',')
         except:
             self.__stab = newstabs
-        list = self.tableau()
-        self.tab = list[0]
-        self.signvector = list[1]
-        while not self.square():
-            print("Invalid input, number of qubits not equal to number of stabilizers")
-            n = int(input("Number of Qubits "))
-            stabs = input("Stabilizers ")
-            self.size = n
-            try:
-                self.__stab = stabs.split(',')
-            except:
-                self.__stab = stabs
-            list = self.tableau()
-            self.tab = list[0]
-            self.signvector = list[1]
-        while self.empty_column():
-            print("Invalid input, free qubit (all stabilizers for some qubit is the identity)")
-            n = int(input("Number of Qubits "))
-            stabs = input("Stabilizers ")
-            self.size = n
-            try:
-                self.__stab = stabs.split(',')
-            except:
-                self.__stab = stabs
-            list = self.tableau()
-            self.tab = list[0]
-            self.signvector = list[1]
-        while not self.commuter() and not ignore_commute:
-            print("Invalid Inputs, Stabilizers do not commute")
-            n = int(input("Number of Qubits "))
-            stabs = input("Stabilizers ")
-            self.size = n
-            try:
-                self.__stab = stabs.split(',')
-            except:
-                self.__stab = stabs
-            list = self.tableau()
-            self.tab = list[0]
-            self.signvector = list[1]
-        while not self.linear_independence():
-            print("Invalid Inputs, Stabilizers are not independant")
-            n = int(input("Number of Qubits "))
-            stabs = input("Stabilizers ")
-            self.size = n
-            try:
-                self.__stab = stabs.split(',')
-            except:
-                self.__stab = stabs
-            list = self.tableau()
-            self.tab = list[0]
-            self.signvector = list[1]
+        if validate != 'none' and not self.square():
+            raise StabilizerError("Invalid input, number of qubits not equal to number of stabilizers")
+        self._load_stabilizers()
+        self.validate(validate, ignore_commute)
 
     def clifford(self,type,q1,q2=None):
         """
@@ -314,52 +360,95 @@ class Stabilizer:
         :param q2: The qubit to target, defaults to None
         :type q2: int
         """
-        if type.lower() == 'h':
-            for i in range(self.size):
-                alpha = self.tab[i,q1]
-                beta = self.tab[i,q1+self.size]
-                self.tab[i,q1]=beta
-                self.tab[i,q1+self.size]=alpha
-                self.signvector[i] = (self.signvector[i]+(alpha*beta))%2
-        elif type.lower() == 'cnot':
+        gate = type.lower()
+        if gate in ('cnot','cz'):
             if q2 == None:
                 print('Recall method and specify second qubit')
+                return
             elif q1 == q2:
-                pass
-            else:
-                for i in range(self.size):
-                    self.tab[i,q2] = (self.tab[i,q1]+self.tab[i,q2])%2
-                    self.tab[i,self.size+q1] = (self.tab[i,q1+self.size]+self.tab[i,q2+self.size])%2
-                    if self.tab[i,q1]==1 and self.tab[i,q2+self.size]==1:
-                        if self.tab[i,q2]==self.tab[i,self.size+q1]:
-                            self.signvector[i]=(self.signvector[i]+1)%2
-        elif type.lower() == 'z':
-            for i in range(self.size):
-                if self.tab[i,q1]==1:
-                    self.signvector[i]=(self.signvector[i]+1)%2
-        elif type.lower() == 'x':
-            for i in range(self.size):
-                if self.tab[i,q1+self.size]==1:
-                    self.signvector[i]=(self.signvector[i]+1)%2
-        elif type.lower() == 'y':
-            for i in range(self.size):
-                if (self.tab[i,q1]+self.tab[i,q1+self.size])==1:
-                    self.signvector[i]=(self.signvector[i]+1)%2
-        elif type.lower() == 's':
-            for i in range(self.size):
-                if self.tab[i,q1]==1:
-                    self.signvector[i]=(self.signvector[i]+self.tab[i,q1+self.size])%2
-                    self.tab[i,q1+self.size] = (self.tab[i,q1+self.size]+1)%2
-        elif type.lower() == 'cz':
-            if q2 == None:
-                print('Recall method and specify second qubit')
-            else:
-                self.clifford('h',q2)
-                self.clifford('cnot',q1,q2)
-                self.clifford('h', q2)
-        else:
+                return
+        elif gate not in ('h','s','x','y','z'):
             print("Something went wrong, make sure you inputted a valid type. Valid types are 'H' for Hadamard, 'S' for the phase gate, 'CNOT' for the Control Not, 'CZ' for the Control Z.")
-    
+            return
+        self._gate_kernel(gate,q1,q2)
+
+    def _gate_kernel(self,gate,q1,q2=None):
+        """
+        Applies a lowercase, already validated gate to every row at once, as XORs of the affected X and Z columns and the signvector
+
+        """
+        self._changed()
+        xs, zs = self._halves()
+        flip = _apply_gate(xs,zs,gate,q1,q2)
+        self.signvector[:] = self.signvector != flip
+        if self._dx is not None:
+            _apply_gate(self._dx,self._dz,gate,q1,q2)
+
+    def apply_circuit(self,ops):
+        """
+        Applies a sequence of clifford gates to the stabilizer. The sequence is decoded and checked once up front, then replayed without any per-gate string dispatch
+
+        :param ops: The gates, either as a list like [['H',0],['CNOT',0,1]] or as an integer array of (gate code, q1, q2) rows from encode_circuit
+        :type ops: list or numpy.ndarray
+        """
+        ops = encode_circuit(ops)
+        if len(ops) == 0:
+            return
+        if ops[:,1:].max() >= self.size:
+            raise ValueError('Circuit acts on a qubit outside the state')
+        if ops[:,0].max() >= GATES.index('measure'):
+            raise ValueError('apply_circuit only applies gates, use simulate for measurements and resets')
+        kernel = self._gate_kernel
+        for code, q1, q2 in ops.tolist():
+            if q1 != q2:
+                kernel(GATES[code],q1,q2)
+
+    def simulate(self, ops, seed = None):
+        """
+        Runs a circuit of clifford gates, Z basis measurements and resets directly on the tableau, with random measurement outcomes drawn as they occur
+
+        :param ops: The operations, either as a list like [['H',0],['CNOT',0,1],['Measure',1],['Reset',0]] or as an integer array of (code, q1, q2) rows from encode_circuit
+        :type ops: list or numpy.ndarray
+
+        :param seed: Seed for the random number generator, defaults to None
+        :type seed: int, optional
+
+        :return: The outcome of every measurement in the circuit (0 or 1), in order
+        :rtype: numpy.ndarray
+        """
+        ops = encode_circuit(ops)
+        measure, reset = GATES.index('measure'), GATES.index('reset')
+        nonunitary = np.count_nonzero(ops[:,0] >= measure) if len(ops) else 0
+        if len(ops) and ops[:,1:].max() >= self.size:
+            raise ValueError('Circuit acts on a qubit outside the state')
+        if nonunitary:
+            self._track_destabilizers()
+        coins = np.random.default_rng(seed).integers(0,2,size=nonunitary).tolist()
+        record = []
+        kernel = self._gate_kernel
+        for code, q1, q2 in ops.tolist():
+            if code == measure or code == reset:
+                px, pz = self._z_observable(q1)
+                outcome = self._measure_pauli(px,pz,0,coins.pop())[0]
+                if code == measure:
+                    record.append(outcome)
+                elif outcome == 1:
+                    kernel('x',q1)
+            elif q1 != q2:
+                kernel(GATES[code],q1,q2)
+        return np.array(record,dtype=np.uint8)
+
+    def _z_observable(self, q):
+        """
+        Returns the X and Z rows of the single qubit observable Z_q, in the layout _measure_pauli expects
+
+        """
+        z = np.zeros((1,self.size),dtype=np.uint8)
+        z[0,q] = 1
+        if self.packed:
+            return _pack_bits(0*z)[0], _pack_bits(z)[0]
+        return 0*z[0], z[0]
+
     def row_commute(self, stab1, stab2):
         if len(stab1)!=len(stab2):
             print("Your stabilizers aren't of same length")
@@ -376,42 +465,156 @@ class Stabilizer:
             return False
     
     def measurement(self, stabilizers, outcomes=None):
+        """
+        Measures Pauli observables one after another, updating the state in place with the Aaronson-Gottesman (CHP) algorithm in O(n^2) per measurement. The destabilizers this needs are built the first time the state is measured and kept up to date by every gate and row operation after that
+
+        :param stabilizers: The Pauli observables to measure, in the format 'XX,-ZI' or ['XX','-ZI']
+        :type stabilizers: list or string
+
+        :param outcomes: The outcomes (0 for +1, 1 for -1) to project onto for the measurements whose result is random, defaults to all 0
+        :type outcomes: list, optional
+
+        :return: The outcome of every measurement, deterministic outcomes being read off the state
+        :rtype: list
+        """
         try:
             stabilizers = stabilizers.split(',')
         except:
             stabilizers = list(stabilizers)
-
-        for i in range(len(stabilizers)):
-            if len(stabilizers[i])!= self.size:
-                print('Stabilizers are wrong, inaccurate size')
-                return
-
-        if outcomes == None:
+        if outcomes is None:
             outcomes = [0 for i in range(len(stabilizers))]
-        stabs = self.stabilizers()
+        px, pz, psign = self._parse_observables(stabilizers)
+        results = []
         for i in range(len(stabilizers)):
-            for j in range(len(stabs)):
-                if not self.row_commute(stabs[j],stabilizers[i]):
-                    index = j
-                    break
-            try:
-                for k in range(index+1,len(stabs)):
-                    if not self.row_commute(stabs[k],stabilizers[i]):
-                        self.row_add(index,k)
-            except:
-                pass
+            result, pivot, rows = self._measure_pauli(px[i],pz[i],psign[i],outcomes[i])
+            results.append(result)
+        return results
 
-            stabs = self.stabilizers()
-            if outcomes[i]==1:
-                stabilizers[i] = '-'+stabilizers[i]
-            try:
-                stabs[index]=stabilizers[i]
-            except:
-                pass
-            self.new_stab(self.size,stabs,True)
+    def sample(self, paulis, shots = 1, seed = None):
+        """
+        Samples the outcomes of measuring Pauli observables one after another, without changing the state. The measurements are simulated once to find which outcomes are random and how the deterministic ones depend on them, then every shot is drawn at once from that structure
 
+        :param paulis: The Pauli observables to measure, in the format 'XX,-ZI' or ['XX','-ZI']
+        :type paulis: list or string
 
+        :param shots: The number of shots, defaults to 1
+        :type shots: int, optional
 
+        :param seed: Seed for the random number generator, defaults to None
+        :type seed: int, optional
+
+        :return: A shots x k array of outcomes (0 for +1, 1 for -1), one column per observable
+        :rtype: numpy.ndarray
+        """
+        try:
+            paulis = paulis.split(',')
+        except:
+            paulis = list(paulis)
+        k = len(paulis)
+        px, pz, psign = self._parse_observables(paulis)
+        scratch = self.clone()
+        # Sign of each row as an affine function of the random outcomes: constant part in the signvector, linear part here
+        dependence = np.zeros((self.size,k),dtype=np.uint8)
+        constant = np.zeros(k,dtype=np.int64)
+        linear = np.zeros((k,k),dtype=np.int64)
+        for i in range(k):
+            result, pivot, rows = scratch._measure_pauli(px[i],pz[i],psign[i],0)
+            if pivot is None:
+                constant[i] = result
+                linear[i] = np.bitwise_xor.reduce(dependence[rows],axis=0) if len(rows) else 0
+            else:
+                dependence[rows] ^= dependence[pivot]
+                dependence[pivot] = 0
+                dependence[pivot,i] = 1
+                linear[i,i] = 1
+        random = np.flatnonzero(np.diag(linear))
+        flips = np.random.default_rng(seed).integers(0,2,size=(shots,len(random)))
+        return ((flips@linear[:,random].T+constant)%2).astype(np.uint8)
+
+    def _parse_observables(self, paulis):
+        """
+        Converts Pauli observables into X and Z rows in the tableau layout (packed for packed states) and a signvector, making sure destabilizers are tracked so they can be measured
+
+        """
+        px, pz, psign = _parse_paulis(paulis,self.size)
+        if self.packed:
+            px, pz = _pack_bits(px), _pack_bits(pz)
+        self._track_destabilizers()
+        return px, pz, psign
+
+    def _measure_pauli(self, px, pz, psign, outcome):
+        """
+        Measures a single Pauli observable (one row from _parse_observables) with the CHP algorithm, projecting onto outcome if the result is random
+
+        :return: The outcome, the stabilizer row replaced by the observable (None if the outcome was deterministic), and the rows that were multiplied by it (or, for deterministic outcomes, the rows whose product gives the observable)
+        :rtype: tuple
+        """
+        xs, zs = self._halves()
+        dx, dz = self._dx, self._dz
+        anti = np.flatnonzero(_anticommuting(xs,zs,px,pz))
+        if len(anti) == 0:
+            anti = np.flatnonzero(_anticommuting(dx,dz,px,pz))
+            return int(self._product_sign(anti))^int(psign), None, anti
+        p = anti[0]
+        self.row_add_many(p,anti[1:])
+        danti = np.flatnonzero(_anticommuting(dx,dz,px,pz))
+        danti = danti[danti!=p]
+        dx[danti] ^= xs[p].astype(dx.dtype)
+        dz[danti] ^= zs[p].astype(dz.dtype)
+        dx[p] = xs[p]
+        dz[p] = zs[p]
+        xs[p] = px
+        zs[p] = pz
+        self._changed()
+        self.signvector[p] = (outcome+psign)%2
+        return int(outcome), p, anti[1:]
+
+    def _product_sign(self, rows):
+        """
+        Returns the sign bit of the product of the given stabilizers, multiplied in order
+
+        """
+        xs, zs = self._halves()
+        accx = np.zeros_like(xs[:1])
+        accz = np.zeros_like(zs[:1])
+        sign = 0
+        for row in rows:
+            phase = _product_phase(xs[row],zs[row],accx,accz)[0]
+            sign = (sign+int(self.signvector[row])+int(phase%4)//2)%2
+            if self.packed:
+                accx ^= xs[row]
+                accz ^= zs[row]
+            else:
+                accx = (accx+xs[row])%2
+                accz = (accz+zs[row])%2
+        return sign
+
+    def destabilizers(self):
+        """
+        Returns a list of the destabilizers of the state, building them first if they are not tracked yet. Destabilizer i anticommutes with stabilizer i and commutes with every other stabilizer and destabilizer (their signs are not tracked)
+
+        :return: The destabilizers as Pauli strings
+        :rtype: list
+        """
+        self._track_destabilizers()
+        if self.packed:
+            return _format_paulis(_unpack_bits(self._dx,self.size),_unpack_bits(self._dz,self.size),np.zeros(self.size))
+        return _format_paulis(self._dx,self._dz,np.zeros(self.size))
+
+    def _track_destabilizers(self):
+        """
+        Builds destabilizers for the current stabilizers if they are not already tracked. This costs a GF(2) elimination once, after which gates and row operations keep them up to date
+
+        """
+        if self._dx is not None:
+            return
+        xs, zs = self._halves()
+        if not self.packed:
+            xs, zs = _pack_bits(xs), _pack_bits(zs)
+        dx, dz = _destabilizers(xs,zs,self.size)
+        if not self.packed:
+            dx, dz = _unpack_bits(dx,self.size), _unpack_bits(dz,self.size)
+        self._dx, self._dz = dx, dz
 
     def report(self):
         """
@@ -426,12 +629,7 @@ class Stabilizer:
         Generates an array that contains information about where stabilizers are known
         
         """
-        self.gauss = np.zeros(self.size*self.size)
-        self.gauss = self.gauss.reshape(self.size,self.size)
-        for i in range(self.size):
-            for j in range(self.size):
-                if self.tab[i,j]==1 or self.tab[i,j+self.size]==1:
-                    self.gauss[i,j]=1
+        self.gauss = ((self.tab[:,:self.size]!=0)|(self.tab[:,self.size:]!=0)).astype(float)
     
     def empty_column(self):
         """
@@ -440,6 +638,9 @@ class Stabilizer:
         :return: Whether there is an empty column or not
         :rtype: boolean
         """
+        if self.packed:
+            occupied = np.bitwise_or.reduce(self.xbits|self.zbits,axis=0)
+            return not np.array_equal(occupied,_pack_bits(np.ones((1,self.size)))[0])
         self.gaussian()
         zed = self.gauss.sum(axis=0)
         empty = False
@@ -450,11 +651,14 @@ class Stabilizer:
 
     def linear_independence(self):
         """
-        Checks if the generators are linearly independent
+        Checks if the generators are linearly independent, by computing the rank of the tableau over GF(2)
 
         """
-        rank = np.linalg.matrix_rank(self.tab)
-        rank = int(rank)
+        if self.packed:
+            rows = np.hstack((self.xbits,self.zbits))
+        else:
+            rows = np.hstack((_pack_bits(self.tab[:,:self.size]),_pack_bits(self.tab[:,self.size:])))
+        rank = _gf2_rank(rows)
         if rank == self.size:
             return True
         else:
@@ -465,133 +669,236 @@ class Stabilizer:
         Multiplies two stabilizers in the tableau together, specifying a new stabilizer, and puts them into the second row
 
         """
-        stabs=self.stabilizers()
-        stab1 = stabs[row1]
-        stab2 = stabs[row2]
-        stab1 = stab1.lstrip('-')
-        stab2 = stab2.lstrip('-')
-        phase = np.ones(self.size, dtype=complex)
-        for i in range(self.size):
-            if stab1[i]=='Z' and stab2[i]=="X":
-                phase[i]=np.complex(1j)*phase[i]
-            elif stab1[i]=='X' and stab2[i]=="Z":
-                phase[i]=np.complex(-1j)*phase[i]
-            elif stab1[i]=='Y' and stab2[i]=="Z":
-                phase[i]=np.complex(1j)*phase[i]
-            elif stab1[i]=='Z' and stab2[i]=="Y":
-                phase[i]=np.complex(-1j)*phase[i]
-            elif stab1[i]=='X' and stab2[i]=="Y":
-                phase[i]=np.complex(1j)*phase[i]
-            elif stab1[i]=='Y' and stab2[i]=="X":
-                phase[i]=np.complex(-1j)*phase[i]
-        toggler = 1
-        for i in range(self.size):
-            toggler = toggler*phase[i]
-        toggler = (1-1*np.real(toggler))/2
-        self.signvector[row2]=(self.signvector[row1]+self.signvector[row2]+toggler)%2
-        for i in range(2*self.size):
-            self.tab[row2,i]=(self.tab[row2,i]+self.tab[row1,i])%2     
+        self.row_add_many(row1,[row2])
 
-    def circuit_builder(self):
+    def row_add_many(self,row1,rows):
         """
-        Uses reverse operations to build the stabilizer state
+        Multiplies the stabilizer in row1 into every row in rows at once, working directly on the X and Z bits. The phase of each product is the sum of the g function over the qubits (mod 4)
+
+        :param row1: The row to multiply in
+        :type row1: int
 
-        :return: A Qiskit circuit that makes the stabilizer
-        :rtype: QuantumCircuit        
+        :param rows: The rows to put the products into, which must be distinct and not include row1
+        :type rows: list or numpy.ndarray
         """
-        reference = np.copy(self.tab)
-        sign = np.copy(self.signvector)
-        rev_operations = []
+        rows = np.asarray(rows,dtype=np.intp)
+        if len(rows) == 0:
+            return
+        self._changed()
+        xs, zs = self._halves()
+        phase = _product_phase(xs[row1],zs[row1],xs[rows],zs[rows])
+        if self.packed:
+            xs[rows] ^= xs[row1]
+            zs[rows] ^= zs[row1]
+        else:
+            xs[rows] = (xs[rows]+xs[row1])%2
+            zs[rows] = (zs[rows]+zs[row1])%2
+        toggler = (phase%4)//2
+        self.signvector[rows] = np.logical_xor(self.signvector[rows] != self.signvector[row1],toggler)
+        if self._dx is not None:
+            self._dx[row1] ^= np.bitwise_xor.reduce(self._dx[rows],axis=0)
+            self._dz[row1] ^= np.bitwise_xor.reduce(self._dz[rows],axis=0)
+
+    def circuit_builder(self, output = 'qiskit', mode = 'standard', cache = True):
+        """
+        Uses reverse operations to build the stabilizer state
 
-        broken = False
+        :param output: 'qiskit' for a Qiskit circuit, or 'gates' for the gates themselves as a structured array (see circuit_array), which does not need Qiskit. Defaults to 'qiskit'
+        :type output: string, optional
 
-        for i in range(self.size):
-            if self.tab[i,i]==0:
-                if self.tab[i,i+self.size]==1:
-                    rev_operations.append(['H',i])
-                    self.clifford('H',i)
-            if self.tab[i,i]==0:
-                for j in range(i+1,self.size):
-                    if self.tab[j,i]==1:
-                        self.tab[[i,j]]=self.tab[[j,i]]
-                        self.signvector[[i,j]]=self.signvector[[j,i]]
-                        break
-            if self.tab[i,i]==0:
-                for j in range(i+1,self.size):
-                    if self.tab[j,i+self.size]==1:
-                        self.tab[[i,j]]=self.tab[[j,i]]
-                        self.signvector[[i,j]]=self.signvector[[j,i]]
-                        rev_operations.append(['H',i])
-                        self.clifford('H',i)
-                        break
-            if self.tab[i,i]==0:
-                for j in range(i):
-                    if self.tab[j,i+self.size]==1:
-                        self.row_add(j,i)
-                        rev_operations.append(['H',i])
-                        self.clifford('H',i)
-                        break
-            if self.tab[i,i]==0:
-                broken = True
-                break
-            elif self.tab[i,i]==1:
-                for j in range(self.size):
-                    if self.tab[i,j]==1 and j!=i:
-                        rev_operations.append(["CNOT",i,j])
-                        self.clifford("CNOT",i,j)
-                
-
-        if broken:
-            self.tab = np.copy(reference)
-            self.signvector = np.copy(sign)
+        :param mode: 'standard' emits the gates stage by stage in row order, 'depth' schedules the commuting CZs into as few parallel layers as it can and merges the single qubit phases (see circuit_stats to compare depths), and 'graph' minimizes the gate count by preparing an LC-equivalent graph state, applying local complementations while they shrink the circuit, followed by the shortest local Clifford on each qubit (falling back on the 'standard' circuit when that is smaller). Defaults to 'standard'
+        :type mode: string, optional
+
+        :param cache: Whether to look the circuit up in (and save it to) the synthesis cache, which is keyed on the canonical form of the state (see circuit_cache_info), defaults to True
+        :type cache: boolean, optional
+
+        :return: A circuit that makes the stabilizer from the all zero state
+        :rtype: QuantumCircuit or numpy.ndarray
+        """
+        if output not in ('qiskit','gates'):
+            raise ValueError("output must be 'qiskit' or 'gates'")
+        if mode not in ('standard','depth','graph'):
+            raise ValueError("mode must be 'standard', 'depth' or 'graph'")
+        key = None
+        if cache and _CIRCUIT_CACHE_INFO['maxsize'] > 0:
+            key = (self.digest(),mode)
+            gates = _cache_lookup(key)
+        if key is None or gates is None:
+            gates = self._synthesize(mode)
+            if gates is None:
+                return None
+            if key is not None:
+                _cache_store(key,gates)
+        if output == 'gates':
+            return gates
+        return circuit_to_qiskit(gates,self.size)
+
+    def _synthesize(self, mode):
+        """
+        Runs the circuit synthesis for circuit_builder on a scratch copy of the state, returning the gates as a structured array, or None if it fails
+
+        """
+        state = self._scratch()
+        n = self.size
+
+        pivots = state._reduce_x()
+        hadamards = [i for i in range(n) if i not in pivots]
+        for i in hadamards:
+            state.clifford('H',i)
+        if len(state._reduce_x()) != n:
             print("Something went wrong in the building procedure. Check your stabilizers and maybe reformat them and try again")
             return None
 
-        for i in range(self.size):
-            if self.tab[i,i+self.size]==1:
-                rev_operations.append(["S",i])
-                self.clifford("S",i)
+        if mode == 'graph':
+            gates = circuit_array(_graph_operations(state,hadamards))
+            # Never do worse than the stage by stage circuit
+            standard = self._synthesize('standard')
+            return gates if len(gates) <= len(standard) else standard
+
+        tab = state.tab
+        phases = [i for i in range(n) if tab[i,i+n]==1]
+        for i in phases:
+            state.clifford("S",i)
+
+        edges = []
+        for i in range(n):
+            for j in range(i+1,n):
+                if tab[i,j+n]==1:
+                    edges.append([i,j])
+                    state.clifford("CZ",i,j)
+
+        for i in range(n):
+            state.clifford('H',i)
+        flips = [i for i in range(n) if state.signvector[i]==1]
+
+        # The circuit runs these stages backwards, and the reverse of S is S followed by Z
+        operations = []
+        if mode == 'standard':
+            operations += [['X',i] for i in reversed(flips)]
+            operations += [['H',i] for i in reversed(range(n))]
+            operations += [['CZ',i,j] for i, j in reversed(edges)]
+            for i in reversed(phases):
+                operations += [['S',i],['Z',i]]
+        else:
+            # X then H is H then Z, and Z commutes with the CZs, so the sign flips join the phases at the end
+            operations += [['H',i] for i in range(n)]
+            operations += [['CZ',i,j] for i, j in _cz_layers(edges)]
+            for i in range(n):
+                power = (3*(i in phases)+2*(i in flips))%4
+                if power % 2 == 1:
+                    operations.append(['S',i])
+                if power >= 2:
+                    operations.append(['Z',i])
+        operations += [['H',i] for i in reversed(hadamards)]
+        gates = circuit_array(operations)
+        if mode == 'depth':
+            # The greedy layering can lose to the stage by stage order, so keep whichever is shallower
+            standard = self._synthesize('standard')
+            if circuit_stats(standard)['depth'] < circuit_stats(gates)['depth']:
+                return standard
+        return gates
+
+    def _scratch(self, packed = False):
+        """
+        Returns a private copy of the state, without destabilizers, for algorithms like circuit synthesis to modify while this state stays untouched. The copy is dense unless packed is True and this state is packed
 
-        for i in range(self.size):
-            for j in range(self.size):
-                if self.tab[i,j+self.size]==1:
-                    rev_operations.append(["CZ",i,j])
-                    self.clifford("CZ",i,j)
+        """
+        state = copy.copy(self)
+        state.packed = packed and self.packed
+        if state.packed:
+            state.xbits = np.copy(self.xbits)
+            state.zbits = np.copy(self.zbits)
+        else:
+            state._tab = np.array(self.tab,dtype=float)
+            vars(state).pop('xbits',None)
+            vars(state).pop('zbits',None)
+        state._signvector = np.array(self.signvector,dtype=float)
+        state._unpacked = None
+        state._dx = state._dz = None
+        return state
 
-        for i in range(self.size):
-            self.clifford('H',i)
-            rev_operations.append(['H',i])
-        
-        for i in range(self.size):
-            if self.signvector[i]==1:
-                rev_operations.append(['X',i])
-                self.clifford('X',i)
-        
-        self.tab = np.copy(reference)
-        self.signvector = np.copy(sign)
-        
-        rev_operations.reverse()
+    def _echelon(self, columns):
+        """
+        Brings the tableau into reduced row echelon form over the given columns (X columns are 0 to n-1 and Z columns n to 2n-1) with row operations, so the signs stay correct
 
-        circuit = QuantumCircuit(self.size)
+        :return: The pivot columns, the ith one being the pivot of row i
+        :rtype: list
+        """
+        n = self.size
+        xs, zs = self._halves()
+        pivots = []
+        for c in columns:
+            row = len(pivots)
+            if row == n:
+                break
+            column = _column(xs,c) if c < n else _column(zs,c-n)
+            hits = np.flatnonzero(column[row:])
+            if len(hits) == 0:
+                continue
+            if hits[0] != 0:
+                self.swap(row,row+hits[0])
+                column[[row,row+hits[0]]] = column[[row+hits[0],row]]
+            others = np.flatnonzero(column)
+            self.row_add_many(row,others[others!=row])
+            pivots.append(c)
+        return pivots
+
+    def _reduce_x(self):
+        """
+        Brings the X half of the tableau into reduced row echelon form with row operations, moving the stabilizers without X parts to the bottom
 
-        
-        for i in range(len(rev_operations)):
-            if rev_operations[i][0]=='H':
-                circuit.h(rev_operations[i][1])
-            elif rev_operations[i][0]=='S':
-                circuit.s(rev_operations[i][1])
-                circuit.z(rev_operations[i][1])
-            elif rev_operations[i][0]=='X':
-                circuit.x(rev_operations[i][1])
-            elif rev_operations[i][0]=='Y':
-                circuit.y(rev_operations[i][1])
-            elif rev_operations[i][0]=='Z':
-                circuit.z(rev_operations[i][1])
-            elif rev_operations[i][0]=='CNOT':
-                circuit.cnot(rev_operations[i][1],rev_operations[i][2])
-            elif rev_operations[i][0]=='CZ':
-                circuit.cz(rev_operations[i][1],rev_operations[i][2])
-        return circuit
+        :return: The pivot columns, the ith one being the pivot of row i
+        :rtype: list
+        """
+        return self._echelon(range(self.size))
+
+    def canonical(self):
+        """
+        Returns a copy of the state in canonical form, the reduced row echelon form of the whole tableau (X columns first). Any two tableaux of the same state have the same canonical form, signs included
+
+        :return: The canonical state
+        :rtype: Stabilizer
+        """
+        state = self._scratch(packed=self.packed)
+        state._echelon(range(2*self.size))
+        return state
+
+    def digest(self):
+        """
+        Returns a 128 bit digest of the canonical form of the state, which is the same for every tableau of the same state. It is cached until the tableau changes
+
+        :return: The digest
+        :rtype: bytes
+        """
+        if self._digest_version != self._version:
+            state = self.canonical()
+            xs, zs = state._halves()
+            if not state.packed:
+                xs, zs = _pack_bits(xs), _pack_bits(zs)
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(np.int64(self.size).tobytes())
+            digest.update(np.ascontiguousarray(xs).tobytes())
+            digest.update(np.ascontiguousarray(zs).tobytes())
+            digest.update(np.packbits(state.signvector.astype(np.uint8)).tobytes())
+            self._digest = digest.digest()
+            self._digest_version = self._version
+        return self._digest
+
+    def __eq__(self, other):
+        """
+        Two Stabilizers are equal when they describe the same state, whatever their tableaux look like
+
+        """
+        if not isinstance(other, Stabilizer):
+            return NotImplemented
+        return self.size == other.size and self.digest() == other.digest()
+
+    def __hash__(self):
+        """
+        Hashes the state through its digest. Changing a state changes its hash, so don't change states that are being used as dictionary keys
+
+        """
+        return int.from_bytes(self.digest()[:8],'little')
 
     def draw_circuit(self, style = 'mpl', save = None):
         """
@@ -632,6 +939,7 @@ class Stabilizer:
         :rtype: StabilizerState (qiskit)
 
         """
+        from qiskit.quantum_info import StabilizerState
         circ = self.circuit_builder()
         stab = StabilizerState(circ)
         return stab
@@ -644,24 +952,24 @@ class Stabilizer:
         :rtype: QuantumCircuit
 
         """
+        from qiskit import QuantumCircuit, ClassicalRegister
         qs = QuantumCircuit(2*self.size)
         bits = []
         for i in range(self.size):
             bits.append(i)
         reg = ClassicalRegister(self.size)
         qs.add_register(reg)
-        stabs = self.stabilizers()
+        tab = self.tab
         for i in range(self.size):
             qs.h(self.size+i)
         for i in range(self.size):
-            stabs[i]=stabs[i].lstrip('-')
             for j in range(self.size):
-                if stabs[i][j]=='X':
+                if tab[i,j]==1 and tab[i,j+self.size]==1:
+                    qs.cy(self.size+i,j)
+                elif tab[i,j]==1:
                     qs.cx(self.size+i,j)
-                elif stabs[i][j]=='Z':
+                elif tab[i,j+self.size]==1:
                     qs.cz(self.size+i,j)
-                elif stabs[i][j]=='Y':
-                    qs.cy(self.size+i,j)
         
         for i in range(self.size):
             qs.h(self.size+i)
@@ -681,6 +989,7 @@ class Stabilizer:
         :rtype: QuantumCircuit
 
         """
+        from qiskit import QuantumCircuit, ClassicalRegister
         circ = self.circuit_builder()
         qs = QuantumCircuit(2*self.size)
         bits = []
@@ -690,18 +999,17 @@ class Stabilizer:
         reg = ClassicalRegister(self.size)
         qs.add_register(reg)
         qs.barrier()
-        stabs = self.stabilizers()
+        tab = self.tab
         for i in range(self.size):
             qs.h(self.size+i)
         for i in range(self.size):
-            stabs[i]=stabs[i].lstrip('-')
             for j in range(self.size):
-                if stabs[i][j]=='X':
+                if tab[i,j]==1 and tab[i,j+self.size]==1:
+                    qs.cy(self.size+i,j)
+                elif tab[i,j]==1:
                     qs.cx(self.size+i,j)
-                elif stabs[i][j]=='Z':
+                elif tab[i,j+self.size]==1:
                     qs.cz(self.size+i,j)
-                elif stabs[i][j]=='Y':
-                    qs.cy(self.size+i,j)
         for i in range(self.size):
             qs.h(self.size+i)
         for i in range(self.size):
@@ -721,23 +1029,47 @@ class Stabilizer:
         :param r2: The second row
         :type q1: int
         """
-        self.tab[[r1, r2]] = self.tab[[r2, r1]]
+        self._changed()
+        if self.packed:
+            self.xbits[[r1, r2]] = self.xbits[[r2, r1]]
+            self.zbits[[r1, r2]] = self.zbits[[r2, r1]]
+        else:
+            self.tab[[r1, r2]] = self.tab[[r2, r1]]
         self.signvector[[r1, r2]] = self.signvector[[r2, r1]]
+        if self._dx is not None:
+            self._dx[[r1, r2]] = self._dx[[r2, r1]]
+            self._dz[[r1, r2]] = self._dz[[r2, r1]]
     def flip(self):
         """
         Flips the tableau over
 
         """
-        self.tab = np.flip(self.tab,axis=0)
+        self._changed()
+        if self.packed:
+            self.xbits = np.flip(self.xbits,axis=0)
+            self.zbits = np.flip(self.zbits,axis=0)
+        else:
+            self._tab = np.flip(self.tab,axis=0)
         self.signvector = np.flip(self.signvector,axis=0)
+        if self._dx is not None:
+            self._dx = np.flip(self._dx,axis=0)
+            self._dz = np.flip(self._dz,axis=0)
     def clone(self):
         """
         Generates a copy of the stabilizer state
 
         """
-        newstab = self.stabilizers()
-        int = self.size
-        state = Stabilizer(n=int,stabs=newstab)
+        state = copy.copy(self)
+        if self.packed:
+            state.xbits = np.copy(self.xbits)
+            state.zbits = np.copy(self.zbits)
+        else:
+            state._tab = np.copy(self._tab)
+        state._signvector = np.copy(self._signvector)
+        state._unpacked = None
+        if self._dx is not None:
+            state._dx = np.copy(self._dx)
+            state._dz = np.copy(self._dz)
         return state
         
 def grapher(edgelist):
@@ -759,6 +1091,8 @@ def grapher(edgelist):
         for j in range(len(edgelist[i])):
             if edgelist[i][j]>num:
                 num = edgelist[i][j]
+    from qiskit import QuantumCircuit
+    from qiskit.quantum_info import StabilizerState
     circuit = QuantumCircuit(num+1, num+1)
     for i in range(num+1):
         circuit.h(i)
@@ -768,80 +1102,58 @@ def grapher(edgelist):
     print(stab)
     return circuit
 
-def rref(state):
+def rref(state, start=0):
     """
-    Function that brings a stabilizer state into rref form
+    Function that brings a stabilizer state into rref form, working directly on the X and Z bits of the tableau. Each qubit column is eliminated with at most two pivot rows (two when more than one kind of Pauli appears in it)
 
     Parameters
     ----------
     state : Stabilizer
         A state that you wish to bring into rref form
+    start : int, optional
+        The first qubit column to eliminate. The columns before it must already be in rref form, as left by an earlier call when only later columns have changed since, and the result is then the same as reducing from scratch. Defaults to 0
+
+    Returns
+    -------
+    leftmost : numpy.ndarray
+        The leftmost qubit that each stabilizer acts on nontrivially, after the reduction (the pivot positions)
     """
     N=state.size
     K=N
-    KU=0
-    NL=0
+    xs, zs = state._halves()
+    NL=start
+    # The rows with a pivot before start sit at the top
+    KU=int(np.count_nonzero(_support(xs,zs,N)[:,:start].any(axis=1)))
     while NL<N-1 and KU< K-1:
-        stabs = state.stabilizers()
-        stabs = remove_sign(stabs)
-        column_stabs = []
-        for k in range(KU,K):
-            column_stabs.append(stabs[k][NL])
-        identity = False
-        oneitem = False
-        twoitem = False
-        distinct_pauli = set(column_stabs)
-        if len(distinct_pauli)==1:
-            if 'I' in distinct_pauli:
-                identity = True
-            else:
-                oneitem = True
-        elif len(distinct_pauli)==2:
-            if 'I' in distinct_pauli:
-                oneitem = True
-            else:
-                twoitem = True
-        else:
-            twoitem = True
-        if identity:
+        # Pauli in column NL of each row from KU down, 0 for I, 1 for X, 2 for Z and 3 for Y
+        paulis = _column(xs,NL)[KU:]+2*_column(zs,NL)[KU:]
+        distinct_pauli = set(np.unique(paulis).tolist())-{0}
+        if len(distinct_pauli)==0:
             NL+=1
-        elif oneitem:
-            for k in range(KU,K):
-                if stabs[k][NL]!='I':
-                    state.swap(KU,k)
-                    break
-            stabs = state.stabilizers()
-            stabs = remove_sign(stabs)
-            for k in range(KU+1,K):
-                if stabs[k][NL]!='I':
-                    state.row_add(KU,k)
+            continue
+        nonidentity = np.flatnonzero(paulis)
+        first = nonidentity[0]
+        reference1 = paulis[first]
+        if first != 0:
+            state.swap(KU,KU+first)
+            paulis[[0,first]] = paulis[[first,0]]
+        if len(distinct_pauli)==1:
+            state.row_add_many(KU,KU+np.flatnonzero(paulis[1:])+1)
             NL+=1
             KU+=1
-        elif twoitem:
-            for k in range(KU,K):
-                if stabs[k][NL]!='I':
-                    reference1 = stabs[k][NL]
-                    state.swap(KU,k)
-                    break
-            for k in range(KU,K):
-                if stabs[k][NL]!='I' and stabs[k][NL]!= reference1:
-                    reference2 = stabs[k][NL]
-                    state.swap(KU+1,k)
-                    break
-            stabs = state.stabilizers()
-            stabs = remove_sign(stabs)
-            for k in range(KU+2,K):
-                if stabs[k][NL]=='I':
-                    continue
-                elif stabs[k][NL]==reference1:
-                    state.row_add(KU,k)
-                elif stabs[k][NL]==reference2:
-                    state.row_add(KU+1,k)
-                elif stabs[k][NL]!='I':
-                    state.row_add(KU,k)
-                    state.row_add(KU+1,k)
-            NL+=1
-            KU+=2
+            continue
+        second = np.flatnonzero((paulis!=0)&(paulis!=reference1))[0]
+        reference2 = paulis[second]
+        if second != 1:
+            state.swap(KU+1,KU+second)
+            paulis[[1,second]] = paulis[[second,1]]
+        rest = paulis[2:]
+        third = (rest!=0)&(rest!=reference1)&(rest!=reference2)
+        state.row_add_many(KU,KU+2+np.flatnonzero((rest==reference1)|third))
+        state.row_add_many(KU+1,KU+2+np.flatnonzero((rest==reference2)|third))
+        NL+=1
+        KU+=2
+    return np.argmax(_support(xs,zs,N),axis=1)
 
 def heightfunction(state):
     """
@@ -854,23 +1166,19 @@ def heightfunction(state):
 
     Returns
     -------
-    height : list
-        The height function evaluated at different values of x
-    """
-    rref(state)
-    state.gaussian()
-    gauss = state.gauss
-    leftmost = []
-    for i in range(state.size):
-        for j in range(state.size):
-            if gauss[i,j]!=0:
-                leftmost.append(j+1)
-                break
-    height = []
-    for i in range(state.size+1):
-        count = sum(j > i for j in leftmost)
-        height.append(state.size-i-count)
-    return height
+    height : numpy.ndarray
+        The height function evaluated at x = 0, 1, ..., n
+    """
+    return _heights(rref(state),state.size)
+
+def _heights(leftmost, n):
+    """
+    Height function of an n qubit state in rref form, from the leftmost qubit of each of its stabilizers
+    """
+    # h(x) = n - x - (number of stabilizers starting at or after qubit x) = (number starting before x) - x
+    starts = np.bincount(leftmost,minlength=n)
+    before = np.concatenate(([0],np.cumsum(starts)))
+    return before-np.arange(n+1)
 
 def plot_height(state):
     """
@@ -882,6 +1190,7 @@ def plot_height(state):
         The state you wish to plot the height function of
     """
     try:
+        import matplotlib.pyplot as plt
         height = heightfunction(state)
         x_val = []
         for i in range(state.size+1):
@@ -908,9 +1217,195 @@ def num_emitters(state):
         The target state you wish to find the number of emitters required to generate photonically
     """
     height = heightfunction(state)
-    emitters = max(height)
+    emitters = int(max(height))
     return emitters
 
+def permute_qubits(state, order):
+    """
+    Function that reorders the qubits of a state
+
+    Parameters
+    ----------
+    state : Stabilizer
+        The state to reorder, which is left untouched
+    order : list
+        The new order, qubit i of the result is qubit order[i] of state
+
+    Returns
+    -------
+    permuted : Stabilizer
+        The reordered state
+    """
+    order = np.asarray(order,dtype=np.intp)
+    if sorted(order.tolist()) != list(range(state.size)):
+        raise ValueError('order must be a permutation of the qubits')
+    tab = state.tab
+    permuted = state.clone()
+    permuted.tab = np.hstack((tab[:,order],tab[:,state.size+order]))
+    return permuted
+
+def optimize_ordering(state, method = 'anneal', order = None, iterations = 10000, seed = None):
+    """
+    Function that searches for a photon ordering needing fewer emitters, by minimizing the maximum of the height function (and then its sum). Heights are kept up to date incrementally: swapping two neighbouring qubits only changes the height at the cut between them, which is found from a basis of the columns of the qubits before it
+
+    Parameters
+    ----------
+    state : Stabilizer
+        The target state
+    method : str, optional
+        'greedy' builds the order one qubit at a time, adding the qubit that keeps the height lowest, 'swaps' swaps neighbouring qubits while that helps, and 'anneal' swaps neighbouring qubits by simulated annealing. Defaults to 'anneal'
+    order : list, optional
+        The order to start the 'swaps' and 'anneal' searches from, defaults to the current order for 'swaps' and the greedy order for 'anneal'
+    iterations : int, optional
+        The number of swaps tried by 'anneal', defaults to 10000
+    seed : int, optional
+        Seed for the random swaps of 'anneal'
+
+    Returns
+    -------
+    order : numpy.ndarray
+        The best order found, qubit i of the reordered state (see permute_qubits) being qubit order[i] of state
+    height : numpy.ndarray
+        The height function of the state in that order, so the number of emitters is height.max()
+    """
+    if method not in ('greedy','swaps','anneal'):
+        raise ValueError("method must be 'greedy', 'swaps' or 'anneal'")
+    n = state.size
+    columns = _column_ints(state)
+    if method == 'greedy' or (method == 'anneal' and order is None):
+        order = _greedy_order(columns)
+        if method == 'greedy':
+            return order, _order_heights(columns,order)[1]
+    order = np.arange(n) if order is None else np.array(order,dtype=np.intp)
+    if sorted(order.tolist()) != list(range(n)):
+        raise ValueError('order must be a permutation of the qubits')
+    bases, height = _order_heights(columns,order)
+    if n < 2:
+        return order, height
+    # counts[h] is the number of cuts at height h, so the maximum can be updated in constant time
+    counts = np.bincount(height,minlength=n+1).tolist()
+    top = int(height.max())
+    total = int(height.sum())
+
+    def swap(k):
+        'Returns the height at cut k+1 after swapping the qubits at k and k+1'
+        return len(bases[k])+_added_rank(bases[k],*columns[order[k+1]])-(k+1)
+
+    def apply(k, h):
+        nonlocal top, total
+        order[k], order[k+1] = order[k+1], order[k]
+        bases[k+1] = _extend_basis(bases[k],columns[order[k]])
+        counts[height[k+1]] -= 1
+        counts[h] += 1
+        total += h-height[k+1]
+        height[k+1] = h
+        top = max(top,h)
+        while counts[top] == 0:
+            top -= 1
+
+    def peek(k, h):
+        'Returns the maximum height if the height at cut k+1 became h'
+        if h >= top:
+            return h
+        if height[k+1] == top and counts[top] == 1:
+            return max(h,top-1 if counts[top-1] else int(max(height[:k+1].max(),height[k+2:].max())))
+        return top
+
+    if method == 'swaps':
+        improved = True
+        while improved:
+            improved = False
+            for k in range(n-1):
+                h = swap(k)
+                if (peek(k,h),total+h-height[k+1]) < (top,total):
+                    apply(k,h)
+                    improved = True
+        return order, height
+
+    rng = np.random.default_rng(seed)
+    ks = rng.integers(0,n-1,size=iterations).tolist()
+    coins = rng.random(iterations).tolist()
+    # The energy is the maximum height with the sum of heights (below 1 after scaling) breaking ties
+    scale = 1/(n*n)
+    best = (top,total,order.copy(),height.copy())
+    for i in range(iterations):
+        temperature = 10**(-2*i/iterations)
+        k = ks[i]
+        h = swap(k)
+        delta = peek(k,h)-top+(h-height[k+1])*scale
+        if delta <= 0 or coins[i] < math.exp(-delta/temperature):
+            apply(k,h)
+            if (top,total) < best[:2]:
+                best = (top,total,order.copy(),height.copy())
+    return best[2], best[3]
+
+def _column_ints(state):
+    """
+    Returns the X and Z columns of each qubit of the tableau as a pair of Python integers, one bit per stabilizer
+    """
+    n = state.size
+    bits = np.packbits(state.tab.T != 0,axis=1)
+    ints = [int.from_bytes(row.tobytes(),'big') for row in bits]
+    return [(ints[q],ints[n+q]) for q in range(n)]
+
+def _reduce(basis, v):
+    """
+    Reduces v against a basis sorted in decreasing order (so with distinct leading bits), giving the smallest vector of its coset
+    """
+    for b in basis:
+        v = min(v,v^b)
+    return v
+
+def _added_rank(basis, x, z):
+    """
+    Returns by how much adding the vectors x and z would increase the rank of basis
+    """
+    x = _reduce(basis,x)
+    z = _reduce(basis,z)
+    # _reduce is linear, so x^z is in the span of basis exactly when the reduced x and z are equal
+    return (x != 0)+(z != 0)-(x != 0 and x == z)
+
+def _extend_basis(basis, vectors):
+    """
+    Returns a copy of basis with the vectors added
+    """
+    basis = list(basis)
+    for v in vectors:
+        v = _reduce(basis,v)
+        if v:
+            basis.append(v)
+            basis.sort(reverse=True)
+    return basis
+
+def _order_heights(columns, order):
+    """
+    Returns the bases of the columns of each prefix of order and the height function for that order, h(x) being the rank of the first x qubits' columns minus x
+    """
+    bases = [[]]
+    for q in order:
+        bases.append(_extend_basis(bases[-1],columns[q]))
+    height = np.array([len(bases[x])-x for x in range(len(order)+1)])
+    return bases, height
+
+def _greedy_order(columns):
+    """
+    Builds an order by repeatedly adding the qubit that increases the rank the least, on ties the one whose columns reduce furthest against the qubits already placed (then the lowest index)
+    """
+    basis = []
+    remaining = list(range(len(columns)))
+    order = []
+
+    def cost(q):
+        x, z = _reduce(basis,columns[q][0]), _reduce(basis,columns[q][1])
+        return (x != 0)+(z != 0)-(x != 0 and x == z), bin(x).count('1')+bin(z).count('1')
+
+    while remaining:
+        q = min(remaining,key=cost)
+        remaining.remove(q)
+        order.append(q)
+        basis = _extend_basis(basis,columns[q])
+    return np.array(order,dtype=np.intp)
+
 def photonic_circuit_solver(state):
     """
     A circuit solver to generate a particular graph state
@@ -919,6 +1414,11 @@ def photonic_circuit_solver(state):
     ----------
     state : Stabilizer
         The target state, such as a resource state, you wish to generate photonically
+
+    Returns
+    -------
+    protocol : numpy.ndarray
+        The operations in the order they are applied, a structured array of PROTOCOL_DTYPE with fields op (the index in PROTOCOL_OPS), emitter, target, photon and step (the time step, each operation placed as early as the qubits it acts on allow). See protocol_stats for a summary
     """
     stabs = state.stabilizers()
     n_e = num_emitters(state)
@@ -930,23 +1430,25 @@ def photonic_circuit_solver(state):
         stabs.append(n_p*'I'+i*'I'+'Z'+(n_e-i-1)*'I')
     target_state = Stabilizer(n_e+n_p,stabs)
     protocol = []
+    a = None
+    # Every step only acts on its photon and the emitters, all to the right of the cuts still to come, so the height
+    # function never changes and the rref form only has to be restored from the current photon's column onwards
+    leftmost = rref(target_state)
+    height = _heights(leftmost,N)
     for j in range(n_p,0,-1):
-        height = heightfunction(target_state)
         photonindex = j-1
+        if j < n_p:
+            rref(target_state,photonindex)
         d = height[j]-height[j-1]
         if d<0:
             'Time Reverse Measurement'
-            gauss = target_state.gauss.tolist()
-            indexfinder = [0 for i in range(N)]
+            support = _support(target_state.tab[:,:N],target_state.tab[:,N:],N)
+            single = np.flatnonzero((support.sum(axis=1)==1)&support[:,n_p:].any(axis=1))
             index=-1
-            for i in range(n_p,N):
-                indexfinder[i] = 1
-                if indexfinder in gauss:
-                    index = i
-                    for k in range(N):
-                        if indexfinder == gauss[k]:
-                            a = k 
-                indexfinder[i] = 0
+            if len(single) != 0:
+                emitters = np.argmax(support[single],axis=1)
+                index = int(emitters.max())
+                a = int(single[emitters==index].max())
             if index != -1:
                 stab = [target_state.tab[a,index],target_state.tab[a,index+N]]
                 if stab == [0,1]:
@@ -977,17 +1479,13 @@ def photonic_circuit_solver(state):
         'Photon Absoprtion'
 
         'Identify Stabilizer'
-        for i in range(N):
-            toggler = True
-            for k in range(photonindex):
-                if target_state.tab[i,k]!=0 or target_state.tab[i,k+N]!=0:
-                    toggler = False
-                    break
-            if target_state.tab[i,photonindex]==0 and target_state.tab[i,photonindex+N]==0:
-                toggler = False
-            if toggler:
-                a = i
-                break
+        support = _support(target_state.tab[:,:N],target_state.tab[:,N:],N)
+        rows = np.flatnonzero(support[:,photonindex]&~support[:,:photonindex].any(axis=1))
+        # With no stabilizer starting at the photon, the one used last is kept
+        if len(rows) != 0:
+            a = int(rows[0])
+        elif a is None:
+            raise StabilizerError('No stabilizer starts at photon '+str(photonindex)+' to absorb it with')
         
         'Bring into Z'
 
@@ -1021,23 +1519,697 @@ def photonic_circuit_solver(state):
 
         'Clear out stabilizers'
 
-        for i in range(N):
-            if i!=a and [target_state.tab[i,photonindex],target_state.tab[i,N+photonindex]]!=[0,0]:
-                target_state.row_add(a,i)
+        clear = np.flatnonzero(_support(target_state.tab[:,:N],target_state.tab[:,N:],N)[:,photonindex])
+        target_state.row_add_many(a,clear[clear!=a])
 
     rref(target_state)
 
     for i in range(n_p):
         if target_state.signvector[i]==1:
             target_state.clifford('X',i)
-            protocol.append([['X'],i])
-    return protocol.reverse()
+            protocol.append(['X',i])
+    protocol.reverse()
+    return _protocol_array(protocol,n_p)
+
+def solve_many(states, workers = None):
+    """
+    Function that runs photonic_circuit_solver over many target states in a pool of worker processes, yielding each protocol as soon as it is ready. The tableaux are sent to the workers bit-packed, and only a few states per worker are in flight at a time, so states can be a generator. The states themselves are left untouched
+
+    Parameters
+    ----------
+    states : iterable
+        The target states, as Stabilizers
+    workers : int, optional
+        The number of worker processes, defaults to the number of CPUs. With 1 the states are solved one by one in this process
+
+    Yields
+    ------
+    index : int
+        The position of the state in states
+    protocol : numpy.ndarray
+        Its protocol, as returned by photonic_circuit_solver. Protocols come back in the order they finish, not the order of states
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError('workers must be at least 1')
+    if workers == 1:
+        for index, state in enumerate(states):
+            yield index, _solve_packed(_pack_state(state))
+        return
+    pool = ProcessPoolExecutor(max_workers=workers)
+    pending = {}
+    try:
+        for index, state in enumerate(states):
+            pending[pool.submit(_solve_packed,_pack_state(state))] = index
+            if len(pending) >= 2*workers:
+                done, _ = wait(pending,return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        while pending:
+            done, _ = wait(pending,return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+
+def _pack_state(state):
+    """
+    Returns the size, bit-packed X and Z halves and signs of a state, the compact form solve_many sends to its workers
+    """
+    if state.packed:
+        xbits, zbits = np.copy(state.xbits), np.copy(state.zbits)
+    else:
+        xbits, zbits = _pack_bits(state.tab[:,:state.size]), _pack_bits(state.tab[:,state.size:])
+    return state.size, xbits, zbits, np.asarray(state.signvector,dtype=np.uint8)
+
+def _solve_packed(packed):
+    """
+    Rebuilds a state from _pack_state's output and solves it, run in the solve_many workers
+    """
+    n, xbits, zbits, sign = packed
+    state = Stabilizer(n,validate='none',packed=True)
+    state.xbits = xbits
+    state.zbits = zbits
+    state.signvector = sign.astype(float)
+    return photonic_circuit_solver(state)
+
+def _protocol_array(protocol, n_p):
+    """
+    Converts a protocol in the format [['H',i],['CNOT',i,j],['Absorption',i,j],['Measure',i,j]], with qubits indexed as in the solver (photons first), into a structured array of PROTOCOL_DTYPE
+    """
+    ops = np.zeros(len(protocol),dtype=PROTOCOL_DTYPE)
+    ops['emitter'] = ops['target'] = ops['photon'] = -1
+    names = {'absorption':'emit'}
+    level = {}
+    for i in range(len(protocol)):
+        name = protocol[i][0].lower()
+        qubits = protocol[i][1:]
+        ops['op'][i] = PROTOCOL_OPS.index(names.get(name,name))
+        if name == 'cnot':
+            ops['emitter'][i] = qubits[0]-n_p
+            ops['target'][i] = qubits[1]-n_p
+        elif len(qubits) == 2:
+            ops['emitter'][i] = qubits[0]-n_p
+            ops['photon'][i] = qubits[1]
+        elif qubits[0] < n_p:
+            ops['photon'][i] = qubits[0]
+        else:
+            ops['emitter'][i] = qubits[0]-n_p
+        step = max(level.get(q,0) for q in qubits)
+        for q in qubits:
+            level[q] = step+1
+        ops['step'][i] = step
+    return ops
+
+def protocol_stats(protocol):
+    """
+    Function that reports the size of an emission protocol
+
+    Parameters
+    ----------
+    protocol : numpy.ndarray
+        A protocol returned by photonic_circuit_solver
+
+    Returns
+    -------
+    stats : dict
+        The number of time steps, the total number of operations, the number of emitters and photons involved, the number of emitter-emitter CNOTs (emitter_cnots) and of measurements, and the count of each operation by name
+    """
+    codes = np.bincount(protocol['op'],minlength=len(PROTOCOL_OPS))
+    stats = {'steps':int(protocol['step'].max())+1 if len(protocol) else 0,'size':len(protocol)}
+    stats['emitters'] = len(np.setdiff1d(np.concatenate((protocol['emitter'],protocol['target'])),[-1]))
+    stats['photons'] = len(np.setdiff1d(protocol['photon'],[-1]))
+    stats['emitter_cnots'] = int(codes[PROTOCOL_OPS.index('cnot')])
+    stats['measurements'] = int(codes[PROTOCOL_OPS.index('measure')])
+    for i in range(len(PROTOCOL_OPS)):
+        stats[PROTOCOL_OPS[i]] = int(codes[i])
+    return stats
+
+def encode_circuit(ops):
+    """
+    Function that encodes a list of gates as a compact integer array
+
+    Parameters
+    ----------
+    ops : list or numpy.ndarray
+        The gates, in the format [['H',0],['CNOT',0,1]], a structured array from circuit_array, or an array that is already encoded
+
+    Returns
+    -------
+    encoded : numpy.ndarray
+        A k x 3 integer array, each row being (gate code, q1, q2) with gate codes indexing GATES and q2 = -1 for single qubit gates
+    """
+    if isinstance(ops,np.ndarray) and ops.dtype.names is not None:
+        encoded = np.stack((ops['gate'],ops['q1'],ops['q2']),axis=-1).astype(np.int64).reshape(-1,3)
+    elif isinstance(ops,np.ndarray):
+        encoded = ops.astype(np.int64).reshape(-1,3)
+    else:
+        encoded = np.full((len(ops),3),-1,dtype=np.int64)
+        for i in range(len(ops)):
+            gate = ops[i][0].lower()
+            if gate not in GATES:
+                raise ValueError('Unknown gate '+repr(ops[i][0]))
+            encoded[i,0] = GATES.index(gate)
+            encoded[i,1:len(ops[i])] = ops[i][1:]
+    if len(encoded) == 0:
+        return encoded
+    if encoded[:,0].min() < 0 or encoded[:,0].max() >= len(GATES):
+        raise ValueError('Unknown gate code in circuit')
+    two_qubit = np.isin(encoded[:,0],[GATES.index('cnot'),GATES.index('cz')])
+    if encoded[:,1].min() < 0 or encoded[two_qubit,2].min(initial=0) < 0:
+        raise ValueError('Circuit is missing a qubit index')
+    encoded[~two_qubit,2] = -1
+    return encoded
+
+def circuit_array(ops):
+    """
+    Function that converts a list of gates into a compact structured array, the backend neutral circuit format
+
+    Parameters
+    ----------
+    ops : list or numpy.ndarray
+        The gates, in any format encode_circuit accepts
+
+    Returns
+    -------
+    gates : numpy.ndarray
+        A structured array of CIRCUIT_DTYPE, with fields gate (the index in GATES), q1 and q2
+    """
+    encoded = encode_circuit(ops)
+    gates = np.zeros(len(encoded),dtype=CIRCUIT_DTYPE)
+    gates['gate'] = encoded[:,0]
+    gates['q1'] = encoded[:,1]
+    gates['q2'] = encoded[:,2]
+    return gates
+
+def circuit_to_qiskit(ops, n=None):
+    """
+    Function that exports a gate list to a Qiskit circuit (requires Qiskit)
+
+    Parameters
+    ----------
+    ops : list or numpy.ndarray
+        The gates, in any format encode_circuit accepts
+    n : int, optional
+        The number of qubits, defaults to one more than the largest qubit index
+
+    Returns
+    -------
+    circuit : QuantumCircuit
+        A Qiskit circuit applying the gates, with one classical bit per qubit if there are measurements (qubit i is measured into bit i)
+    """
+    from qiskit import QuantumCircuit
+    encoded = encode_circuit(ops)
+    if n is None:
+        n = int(encoded[:,1:].max())+1 if len(encoded) else 0
+    if np.any(encoded[:,0] == GATES.index('measure')):
+        circuit = QuantumCircuit(n,n)
+    else:
+        circuit = QuantumCircuit(n)
+    for code, q1, q2 in encoded.tolist():
+        gate = GATES[code]
+        if gate == 'cnot':
+            circuit.cx(q1,q2)
+        elif gate == 'cz':
+            circuit.cz(q1,q2)
+        elif gate == 'measure':
+            circuit.measure(q1,q1)
+        else:
+            getattr(circuit,gate)(q1)
+    return circuit
+
+def circuit_to_qasm(ops, n=None):
+    """
+    Function that exports a gate list to OpenQASM 2.0 text
+
+    Parameters
+    ----------
+    ops : list or numpy.ndarray
+        The gates, in any format encode_circuit accepts
+    n : int, optional
+        The number of qubits, defaults to one more than the largest qubit index
+
+    Returns
+    -------
+    qasm : str
+        The OpenQASM program, with a classical register c the size of q if there are measurements (q[i] is measured into c[i])
+    """
+    encoded = encode_circuit(ops)
+    if n is None:
+        n = int(encoded[:,1:].max())+1 if len(encoded) else 0
+    lines = ['OPENQASM 2.0;','include "qelib1.inc";','qreg q['+str(n)+'];']
+    if np.any(encoded[:,0] == GATES.index('measure')):
+        lines.append('creg c['+str(n)+'];')
+    names = {'cnot':'cx'}
+    for code, q1, q2 in encoded.tolist():
+        gate = GATES[code]
+        if gate == 'measure':
+            lines.append('measure q[%d] -> c[%d];' % (q1,q1))
+        elif q2 >= 0:
+            lines.append('%s q[%d],q[%d];' % (names.get(gate,gate),q1,q2))
+        else:
+            lines.append('%s q[%d];' % (gate,q1))
+    return '\n'.join(lines)+'\n'
+
+# LRU cache of circuit_builder results, keyed on (canonical digest, mode)
+_CIRCUIT_CACHE = OrderedDict()
+_CIRCUIT_CACHE_INFO = {'hits':0,'misses':0,'maxsize':256}
+_CIRCUIT_CACHE_LOCK = threading.Lock()
+
+def circuit_cache_info():
+    """
+    Function that reports on the circuit synthesis cache used by circuit_builder
+
+    Returns
+    -------
+    info : dict
+        The number of hits and misses, the maximum number of circuits kept (maxsize) and the number currently kept (currsize)
+    """
+    with _CIRCUIT_CACHE_LOCK:
+        info = dict(_CIRCUIT_CACHE_INFO)
+        info['currsize'] = len(_CIRCUIT_CACHE)
+    return info
+
+def set_circuit_cache_size(maxsize):
+    """
+    Function that sets how many circuits the synthesis cache keeps, evicting the least recently used ones if it shrinks
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of circuits, 0 turns the cache off
+    """
+    if maxsize < 0:
+        raise ValueError('maxsize must not be negative')
+    with _CIRCUIT_CACHE_LOCK:
+        _CIRCUIT_CACHE_INFO['maxsize'] = maxsize
+        while len(_CIRCUIT_CACHE) > maxsize:
+            _CIRCUIT_CACHE.popitem(last=False)
+
+def clear_circuit_cache():
+    """
+    Function that empties the circuit synthesis cache and resets its hit and miss counters
+    """
+    with _CIRCUIT_CACHE_LOCK:
+        _CIRCUIT_CACHE.clear()
+        _CIRCUIT_CACHE_INFO['hits'] = 0
+        _CIRCUIT_CACHE_INFO['misses'] = 0
+
+def _cache_lookup(key):
+    """
+    Returns a copy of the cached gates for key, or None, counting the hit or miss
+    """
+    with _CIRCUIT_CACHE_LOCK:
+        gates = _CIRCUIT_CACHE.get(key)
+        if gates is None:
+            _CIRCUIT_CACHE_INFO['misses'] += 1
+            return None
+        _CIRCUIT_CACHE.move_to_end(key)
+        _CIRCUIT_CACHE_INFO['hits'] += 1
+    return gates.copy()
+
+def _cache_store(key, gates):
+    """
+    Saves a copy of the gates for key, evicting the least recently used circuit if the cache is full
+    """
+    with _CIRCUIT_CACHE_LOCK:
+        if _CIRCUIT_CACHE_INFO['maxsize'] == 0:
+            return
+        _CIRCUIT_CACHE[key] = gates.copy()
+        _CIRCUIT_CACHE.move_to_end(key)
+        while len(_CIRCUIT_CACHE) > _CIRCUIT_CACHE_INFO['maxsize']:
+            _CIRCUIT_CACHE.popitem(last=False)
+
+def circuit_stats(ops):
+    """
+    Function that reports the size of a circuit
+
+    Parameters
+    ----------
+    ops : list or numpy.ndarray
+        The gates, in any format encode_circuit accepts
+
+    Returns
+    -------
+    stats : dict
+        The depth (each operation placed as early as the qubits it acts on allow), the total number of operations, the number of two qubit gates, and the count of each operation by name
+    """
+    encoded = encode_circuit(ops)
+    level = {}
+    depth = 0
+    for code, q1, q2 in encoded.tolist():
+        qubits = (q1,q2) if q2 >= 0 else (q1,)
+        layer = max(level.get(q,0) for q in qubits)+1
+        for q in qubits:
+            level[q] = layer
+        depth = max(depth,layer)
+    codes = np.bincount(encoded[:,0],minlength=len(GATES))
+    stats = {'depth':depth,'size':len(encoded),'two_qubit':int(np.count_nonzero(encoded[:,2] >= 0))}
+    for i in range(len(GATES)):
+        stats[GATES[i]] = int(codes[i])
+    return stats
+
+def _graph_operations(state, hadamards):
+    """
+    Finishes the synthesis of a scratch state whose X half has been reduced to the identity (after Hadamards on the qubits in hadamards) as an LC-equivalent graph state. A local complementation is applied whenever it makes the whole circuit smaller, counting the CZs of the edges and the shortest local Clifford on each qubit, then the circuit is returned as Hadamards, the CZs of the remaining edges in layers, and those local Cliffords
+    """
+    n = state.size
+    # The single qubit gates the reverse process applies to each qubit, in order
+    local = [[] for i in range(n)]
+    for i in hadamards:
+        local[i].append('h')
+    _clear_graph_phases(state,local)
+    best = _graph_circuit(state,local)
+    improved = True
+    while improved:
+        improved = False
+        for v in range(n):
+            neighbours = np.flatnonzero(state.tab[v,n:])
+            if len(neighbours) < 2:
+                continue
+            # Local complementation at v toggles every edge between its neighbours
+            trial = state._scratch()
+            trial_local = [list(gates) for gates in local]
+            for gate in ('h','s','h'):
+                trial.clifford(gate,v)
+                trial_local[v].append(gate)
+            for u in neighbours:
+                trial.clifford('S',u)
+                trial_local[u].append('s')
+            trial._reduce_x()
+            _clear_graph_phases(trial,trial_local)
+            operations = _graph_circuit(trial,trial_local)
+            if len(operations) < len(best):
+                state, local, best = trial, trial_local, operations
+                improved = True
+                break
+    return best
+
+def _clear_graph_phases(state, local):
+    """
+    Removes the self loops (Z on a qubit's own stabilizer) of a graph form scratch state with S gates, recording them in local
+    """
+    n = state.size
+    for i in np.flatnonzero(np.diagonal(state.tab[:,n:])):
+        state.clifford('S',i)
+        local[i].append('s')
+
+def _graph_circuit(state, local):
+    """
+    Returns the operations preparing a graph form scratch state (left untouched) given the local gates applied to reach it
+    """
+    n = state.size
+    state = state._scratch()
+    tab = state.tab
+    edges = [[i,j] for i in range(n) for j in range(i+1,n) if tab[i,j+n]==1]
+    for i, j in edges:
+        state.clifford('CZ',i,j)
+    for i in range(n):
+        state.clifford('H',i)
+
+    # Undo the local gates last to first. The sign-fixing X before the Hadamard becomes a Z after it, which commutes past the CZs
+    inverse = {'h':['h'],'s':['s','z']}
+    entangled = set(q for edge in edges for q in edge)
+    words = []
+    for i in range(n):
+        word = ['z'] if state.signvector[i]==1 else []
+        for gate in reversed(local[i]):
+            word += inverse[gate]
+        if i not in entangled:
+            word = ['h']+word
+        words.append(_shortest_clifford(word))
+    operations = [['H',i] for i in sorted(entangled)]
+    operations += [['CZ',i,j] for i, j in _cz_layers(edges)]
+    for i in range(n):
+        operations += [[gate.upper(),i] for gate in words[i]]
+    return operations
+
+_SHORTEST_CLIFFORDS = {}
+
+def _clifford_key(word):
+    """
+    Identifies the single qubit Clifford applied by a sequence of lowercase gates (up to a global phase) by where it sends X and Z
+    """
+    xs = np.array([[1],[0]],dtype=np.uint8)
+    zs = np.array([[0],[1]],dtype=np.uint8)
+    sign = np.zeros(2,dtype=np.uint8)
+    for gate in word:
+        sign = (sign+_apply_gate(xs,zs,gate,0))%2
+    return tuple(xs[:,0])+tuple(zs[:,0])+tuple(sign)
+
+def _shortest_clifford(word):
+    """
+    Returns a shortest sequence of H, S, X, Y and Z gates that applies the same single qubit Clifford as word
+    """
+    if not _SHORTEST_CLIFFORDS:
+        frontier = [[]]
+        _SHORTEST_CLIFFORDS[_clifford_key([])] = []
+        while frontier:
+            grown = []
+            for base in frontier:
+                for gate in ('h','s','x','y','z'):
+                    candidate = base+[gate]
+                    key = _clifford_key(candidate)
+                    if key not in _SHORTEST_CLIFFORDS:
+                        _SHORTEST_CLIFFORDS[key] = candidate
+                        grown.append(candidate)
+            frontier = grown
+    return list(_SHORTEST_CLIFFORDS[_clifford_key(word)])
+
+def _cz_layers(edges):
+    """
+    Orders commuting two qubit gates into layers that act on disjoint qubits, by greedily edge colouring the interaction graph starting from its busiest qubits. Returns the edges sorted by layer
+    """
+    degree = {}
+    for i, j in edges:
+        degree[i] = degree.get(i,0)+1
+        degree[j] = degree.get(j,0)+1
+    order = sorted(edges,key=lambda edge: -(degree[edge[0]]+degree[edge[1]]))
+    used = {}
+    layers = []
+    for i, j in order:
+        taken = used.setdefault(i,set()) | used.setdefault(j,set())
+        colour = 0
+        while colour in taken:
+            colour += 1
+        used[i].add(colour)
+        used[j].add(colour)
+        layers.append((colour,i,j))
+    layers.sort()
+    return [[i,j] for colour, i, j in layers]
 
 def remove_sign(stabs):
     for i in range(len(stabs)):
         stabs[i] = stabs[i].lstrip('-')
     return stabs
 
+_PAULI_X = np.zeros(256,dtype=np.uint8)
+_PAULI_X[[ord('X'),ord('Y')]] = 1
+_PAULI_Z = np.zeros(256,dtype=np.uint8)
+_PAULI_Z[[ord('Z'),ord('Y')]] = 1
+_PAULI_VALID = np.zeros(256,dtype=bool)
+_PAULI_VALID[[ord('I'),ord('X'),ord('Y'),ord('Z')]] = True
+
+def _parse_paulis(stabs, n):
+    """
+    Converts Pauli strings of length n (optionally signed with a leading '-') into X and Z bit arrays and a signvector, all at once through a byte lookup table
+    """
+    sign = np.array([stab[:1]=='-' for stab in stabs],dtype=float)
+    bodies = [stab[1:] if stab[:1]=='-' else stab for stab in stabs]
+    if any(len(body) != n for body in bodies):
+        raise StabilizerError("Invalid input, number of qubits not equal to number of stabilizers")
+    try:
+        codes = np.frombuffer(''.join(bodies).encode('ascii'),dtype=np.uint8).reshape(len(bodies),n)
+    except UnicodeEncodeError:
+        raise StabilizerError('Invalid Stabilizer')
+    if not _PAULI_VALID[codes].all():
+        raise StabilizerError('Invalid Stabilizer')
+    return _PAULI_X[codes], _PAULI_Z[codes], sign
+
+_PAULI_CHARS = np.frombuffer(b'IXZY',dtype=np.uint8)
+
+def _format_paulis(x, z, sign):
+    """
+    Inverse of _parse_paulis, converts X and Z bit arrays and a signvector back into a list of Pauli strings
+    """
+    codes = _PAULI_CHARS[(x&1)+2*(z&1)]
+    return [('-' if s==1 else '')+row.tobytes().decode('ascii') for row, s in zip(codes,sign)]
+
+def _pack_bits(bits):
+    """
+    Packs each row of a 0/1 array into little-endian uint64 words, bit j of a row landing in word j//64
+    """
+    bits = np.asarray(bits)
+    words = (bits.shape[1]+63)//64
+    packed = np.zeros((bits.shape[0],8*words),dtype=np.uint8)
+    packed[:,:(bits.shape[1]+7)//8] = np.packbits(bits!=0,axis=1,bitorder='little')
+    return packed.view('<u8')
+
+def _unpack_bits(words, ncols):
+    """
+    Inverse of _pack_bits, returns the first ncols bits of each row as a uint8 array
+    """
+    bytes = np.ascontiguousarray(words,dtype='<u8').view(np.uint8)
+    return np.unpackbits(bytes,axis=1,count=ncols,bitorder='little')
+
+def _popcount(words):
+    """
+    Number of set bits in each uint64 word
+    """
+    words = np.ascontiguousarray(words,dtype='<u8')
+    if hasattr(np,'bitwise_count'):
+        return np.bitwise_count(words)
+    return np.unpackbits(words[...,np.newaxis].view(np.uint8),axis=-1).sum(axis=-1)
+
+def _gf2_eliminate(rows, ncols, reduced=False):
+    """
+    Gaussian elimination over GF(2) on the first ncols columns of a matrix whose rows are packed into uint64 words (rows is overwritten with the echelon form). If reduced, pivots are also cleared from the rows above them. Returns the pivot columns
+    """
+    nrows = rows.shape[0]
+    pivots = []
+    for c in range(ncols):
+        rank = len(pivots)
+        if rank == nrows:
+            break
+        col = (rows[rank:,c>>6]>>np.uint64(c&63))&np.uint64(1)
+        hits = np.flatnonzero(col)
+        if len(hits) == 0:
+            continue
+        pivot = rank+hits[0]
+        if pivot != rank:
+            rows[[rank,pivot]] = rows[[pivot,rank]]
+        targets = rank+hits[1:]
+        if reduced:
+            above = np.flatnonzero((rows[:rank,c>>6]>>np.uint64(c&63))&np.uint64(1))
+            targets = np.concatenate((above,targets))
+        rows[targets] ^= rows[rank]
+        pivots.append(c)
+    return pivots
+
+def _gf2_rank(rows):
+    """
+    Rank over GF(2) of a matrix whose rows are packed into uint64 words, found by Gaussian elimination on the words (rows is overwritten)
+    """
+    return len(_gf2_eliminate(rows,64*rows.shape[1]))
+
+def _destabilizers(xs, zs, n):
+    """
+    Finds destabilizers for n independent, commuting stabilizers whose X and Z halves are packed into uint64 words. Solves for Paulis with the right symplectic products against the stabilizers, then multiplies stabilizers in to make them commute with each other. Returns their X and Z halves, packed the same way
+    """
+    words = xs.shape[1]
+    identity = np.zeros((n,words),dtype='<u8')
+    diagonal = np.arange(n)
+    identity[diagonal,diagonal>>6] = np.uint64(1)<<(diagonal&63).astype(np.uint64)
+    # The Z half comes first so that the solution's X half pairs with it, the padding columns past n in each half stay 0
+    rows = np.hstack((zs,xs,identity))
+    pivots = np.array(_gf2_eliminate(rows,128*words,reduced=True))
+    if len(pivots) != n:
+        raise StabilizerError("Invalid Inputs, Stabilizers are not independant")
+    inverse = rows[:,2*words:]
+    # Destabilizer i has bit pivots[k] set when bit i of row k of the inverse is, so the inverse is transposed one output word at a time
+    halves = []
+    for offset in (0,64*words):
+        half = np.zeros((n,words),dtype='<u8')
+        ks = np.flatnonzero((pivots>=offset)&(pivots<offset+64*words))
+        cols = pivots[ks]-offset
+        for w in np.unique(cols>>6):
+            block = np.zeros((64,n),dtype=np.uint8)
+            inword = ks[(cols>>6)==w]
+            block[pivots[inword]-offset-64*w] = _unpack_bits(inverse[inword],n)
+            half[:,w] = _pack_bits(block.T)[:,0]
+        halves.append(half)
+    dx, dz = halves
+    # XOR stabilizer j into destabilizer i for j < i whenever the original destabilizers i and j anticommute, last row first so the rows still to be checked are unchanged
+    for i in range(n-1,0,-1):
+        anti = np.flatnonzero(_anticommuting(dx[:i],dz[:i],dx[i],dz[i]))
+        if len(anti):
+            dx[i] ^= np.bitwise_xor.reduce(xs[anti],axis=0)
+            dz[i] ^= np.bitwise_xor.reduce(zs[anti],axis=0)
+    return dx, dz
+
+def _apply_gate(xs, zs, gate, q1, q2=None):
+    """
+    Applies a lowercase gate to the X and Z halves of a tableau (dense, or packed into uint64 words) in place, returning the sign flip of every row
+    """
+    x1 = _column(xs,q1)
+    z1 = _column(zs,q1)
+    if gate == 'h':
+        flip = x1&z1
+        _set_column(xs,q1,z1)
+        _set_column(zs,q1,x1)
+    elif gate == 's':
+        flip = x1&z1
+        _set_column(zs,q1,z1^x1)
+    elif gate == 'x':
+        flip = z1
+    elif gate == 'y':
+        flip = x1^z1
+    elif gate == 'z':
+        flip = x1
+    else:
+        x2 = _column(xs,q2)
+        z2 = _column(zs,q2)
+        if gate == 'cnot':
+            flip = x1&z2&~(x2^z1)&1
+            _set_column(xs,q2,x2^x1)
+            _set_column(zs,q1,z1^z2)
+        else:
+            flip = x1&x2&(z1^z2)
+            _set_column(zs,q1,z1^x2)
+            _set_column(zs,q2,z2^x1)
+    return flip
+
+def _product_phase(x1, z1, x2, z2):
+    """
+    Returns, for every row of (x2, z2), the power of i picked up (mod 4 after reduction) when the Pauli (x1, z1) multiplies it from the left, as the sum of the g function over the qubits. Rows are dense bits or packed uint64 words
+    """
+    if x2.dtype == np.uint64:
+        plus = (x1&z1&z2&~x2) | (x1&~z1&x2&z2) | (~x1&z1&x2&~z2)
+        minus = (x1&z1&x2&~z2) | (x1&~z1&~x2&z2) | (~x1&z1&x2&z2)
+        return _popcount(plus).sum(axis=1,dtype=np.int64)-_popcount(minus).sum(axis=1,dtype=np.int64)
+    x1, z1 = x1.astype(np.int64), z1.astype(np.int64)
+    x2, z2 = x2.astype(np.int64), z2.astype(np.int64)
+    g = x1*z1*(z2-x2) + x1*(1-z1)*z2*(2*x2-1) + (1-x1)*z1*x2*(1-2*z2)
+    return g.sum(axis=1)
+
+def _anticommuting(xs, zs, px, pz):
+    """
+    Returns, for every row of a tableau half pair (dense, or packed into uint64 words), whether it anticommutes with the Pauli (px, pz) given in the same layout
+    """
+    if xs.dtype == np.uint64:
+        return _popcount((xs&pz)^(zs&px)).sum(axis=1)%2 == 1
+    # Only the qubits the Pauli acts on matter, so just those columns are summed
+    return (xs[:,pz!=0].sum(axis=1)+zs[:,px!=0].sum(axis=1))%2 == 1
+
+def _support(xs, zs, n):
+    """
+    Returns an n column boolean array of where each row of a tableau (dense, or packed into uint64 words) acts nontrivially
+    """
+    if xs.dtype == np.uint64:
+        return _unpack_bits(xs|zs,n).astype(bool)
+    return (xs!=0)|(zs!=0)
+
+def _column(half, q):
+    """
+    Returns column q of one half of a tableau (dense, or packed into uint64 words) as an integer array of 0s and 1s
+    """
+    if half.dtype == np.uint64:
+        return (half[:,q>>6]>>np.uint64(q&63))&np.uint64(1)
+    return half[:,q].astype(np.uint8)
+
+def _set_column(half, q, bits):
+    """
+    Overwrites column q of one half of a tableau (dense, or packed into uint64 words) with bits
+    """
+    if half.dtype != np.uint64:
+        half[:,q] = bits&1
+        return
+    shift = np.uint64(q&63)
+    half[:,q>>6] = (half[:,q>>6]&~(np.uint64(1)<<shift))|((bits.astype(np.uint64)&np.uint64(1))<<shift)
+
 
 
 
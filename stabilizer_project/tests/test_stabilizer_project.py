@@ -3,6 +3,8 @@ Unit and regression test for the stabilizer_project package.
 """
 
 # Import package, test suite, and other packages as needed
+import os
+import subprocess
 import sys
 
 import pytest
@@ -32,3 +34,303 @@ def test_circuit_builder_functions():
         tester = False
     assert tester
     
+
+def test_packed_matches_dense():
+    dense = stabilizer_project.Stabilizer(edgelist=[[0,1],[1,2],[2,3],[3,0]])
+    packed = stabilizer_project.Stabilizer(edgelist=[[0,1],[1,2],[2,3],[3,0]], packed=True)
+    for state in [dense, packed]:
+        state.clifford('H',0)
+        state.clifford('S',2)
+        state.clifford('CNOT',1,3)
+        state.clifford('CZ',0,2)
+    assert np.array_equal(dense.tab, packed.tab)
+    assert np.array_equal(dense.signvector, packed.signvector)
+    assert packed.xbits.dtype == np.uint64
+    for empty in [stabilizer_project.Stabilizer(edgelist=[]), stabilizer_project.Stabilizer(edgelist=[], packed=True)]:
+        assert empty.stabilizers() == ['X']
+
+def test_packed_row_add():
+    state = stabilizer_project.Stabilizer(2, 'XX,ZZ', packed=True)
+    state.row_add(0,1)
+    assert state.stabilizers() == ['XX', '-YY']
+
+def test_cz_kernel_matches_decomposition():
+    direct = stabilizer_project.Stabilizer(3, 'XZI,-ZXZ,IZY')
+    composed = stabilizer_project.Stabilizer(3, 'XZI,-ZXZ,IZY')
+    direct.clifford('CZ',0,1)
+    composed.clifford('H',1)
+    composed.clifford('CNOT',0,1)
+    composed.clifford('H',1)
+    assert np.array_equal(direct.tab, composed.tab)
+    assert np.array_equal(direct.signvector, composed.signvector)
+
+def test_apply_circuit():
+    ops = [['H',0],['CNOT',0,1],['S',1],['CZ',1,2],['Y',2]]
+    one_by_one = stabilizer_project.Stabilizer(3)
+    for op in ops:
+        one_by_one.clifford(*op)
+    batched = stabilizer_project.Stabilizer(3)
+    batched.apply_circuit(ops)
+    encoded = stabilizer_project.Stabilizer(3, packed=True)
+    encoded.apply_circuit(stabilizer_project.encode_circuit(ops))
+    assert batched.stabilizers() == one_by_one.stabilizers()
+    assert encoded.stabilizers() == one_by_one.stabilizers()
+
+def test_commuter_reports_pairs():
+    for packed in [False, True]:
+        state = stabilizer_project.Stabilizer(3, packed=packed)
+        assert state.commuter()
+        state.tab = np.array([[1,1,0,0,1,0],[1,1,0,1,0,0],[0,0,1,1,0,0]])
+        commute, pairs = state.commuter(pairs=True)
+        assert not commute
+        assert pairs.tolist() == [[0,2],[1,2]]
+
+def test_linear_independence_over_gf2():
+    for packed in [False, True]:
+        state = stabilizer_project.Stabilizer(3, packed=packed)
+        assert state.linear_independence()
+        # XXI * IXX = XIX, dependent over GF(2) but full rank over the reals
+        state.tab = np.array([[1,1,0,0,0,0],[0,1,1,0,0,0],[1,0,1,0,0,0]])
+        assert not state.linear_independence()
+
+def test_invalid_stabilizers_raise():
+    with pytest.raises(stabilizer_project.StabilizerError):
+        stabilizer_project.Stabilizer(2, 'XX,ZI')
+    with pytest.raises(stabilizer_project.StabilizerError):
+        stabilizer_project.Stabilizer(2, 'XX,XX')
+    with pytest.raises(stabilizer_project.StabilizerError):
+        stabilizer_project.Stabilizer(2, 'XX,ZI', validate='cheap').validate()
+    state = stabilizer_project.Stabilizer(2, 'XX,ZI', validate='none')
+    assert state.stabilizers() == ['XX', 'ZI']
+
+def test_tableau_parser():
+    state = stabilizer_project.Stabilizer(3, '-XZI,ZYZ,IZX')
+    assert np.array_equal(state.tab, np.array([[1,0,0,0,1,0],[0,1,0,1,1,1],[0,0,1,0,1,0]]))
+    assert np.array_equal(state.signvector, np.array([1,0,0]))
+    packed = stabilizer_project.Stabilizer(3, '-XZI,ZYZ,IZX', packed=True)
+    assert np.array_equal(packed.tab, state.tab)
+    with pytest.raises(stabilizer_project.StabilizerError):
+        stabilizer_project.Stabilizer(2, 'XQ,ZZ')
+
+def test_stabilizer_strings_cached():
+    for packed in [False, True]:
+        state = stabilizer_project.Stabilizer(2, 'XX,ZZ', packed=packed)
+        stabs = state.stabilizers()
+        stabs[0] = 'II'
+        assert state.stabilizers() == ['XX', 'ZZ']
+        state.clifford('H',0)
+        assert state.stabilizers() == ['ZX', 'XZ']
+        state.swap(0,1)
+        state.signvector = np.array([1,0])
+        assert state.stabilizers() == ['-XZ', 'ZX']
+
+def test_row_add_phases():
+    for packed in [False, True]:
+        state = stabilizer_project.Stabilizer(3, 'XZI,ZXZ,IZX', packed=packed)
+        state.row_add(1,0)
+        assert state.stabilizers() == ['YYZ', 'ZXZ', 'IZX']
+        state.row_add_many(2,[0,1])
+        assert state.stabilizers() == ['-YXY', 'ZYY', 'IZX']
+
+def test_measurement_chp():
+    for packed in [False, True]:
+        state = stabilizer_project.Stabilizer(3, packed=packed)
+        state.clifford('H',0)
+        state.clifford('CNOT',0,1)
+        assert state.measurement('ZZI,IIZ,-ZZI') == [0, 0, 1]
+        assert state.measurement(['XII'], outcomes=[1]) == [1]
+        assert sorted(state.stabilizers()) == ['-XII', 'IIZ', 'XXI']
+        assert state.measurement('IZI,XII') == [0, 1]
+        destabs = state.destabilizers()
+        assert all(state.row_commute(destabs[i], stab) != (i == j) for i in range(3) for j, stab in enumerate(state.stabilizers()))
+
+def test_sample_shots():
+    for packed in [False, True]:
+        state = stabilizer_project.Stabilizer(edgelist=[[0,1],[1,2]], packed=packed)
+        shots = state.sample('ZII,IIZ,ZIZ,XZI,-ZXZ', shots=200, seed=1)
+        assert shots.shape == (200, 5)
+        assert state.stabilizers() == ['XZI', 'ZXZ', 'IZX']
+        assert set(shots[:,0]) == {0, 1}
+        assert np.array_equal(shots[:,2], shots[:,0]^shots[:,1])
+        assert shots[:,4].all()
+
+def test_simulate_circuit():
+    ops = [['H',0],['CNOT',0,1],['Measure',0],['Measure',1],['Reset',0],['X',1],['Measure',0],['H',2],['Measure',2]]
+    records = []
+    for seed in range(20):
+        for packed in [False, True]:
+            state = stabilizer_project.Stabilizer(3, packed=packed)
+            record = state.simulate(ops, seed=seed)
+            assert record[0] == record[1] and record[2] == 0
+            assert state.measurement('IZI') == [1-record[1]]
+            records.append(record)
+    assert {r[0] for r in records} == {0, 1}
+    with pytest.raises(ValueError):
+        stabilizer_project.Stabilizer(3).apply_circuit([['Measure',0]])
+
+def test_qiskit_imported_lazily():
+    root = os.path.dirname(os.path.dirname(stabilizer_project.__file__))
+    check = "import sys, stabilizer_project; stabilizer_project.Stabilizer(3).measurement('ZII'); assert 'qiskit' not in sys.modules"
+    result = subprocess.run([sys.executable, '-c', check], cwd=root)
+    assert result.returncode == 0
+
+def test_circuit_builder_gate_list():
+    state = stabilizer_project.Stabilizer(3, '-XZI,ZYZ,IZX')
+    gates = state.circuit_builder(output='gates')
+    assert gates.dtype == stabilizer_project.CIRCUIT_DTYPE
+    built = stabilizer_project.Stabilizer(3)
+    built.simulate(gates)
+    assert built.measurement(state.stabilizers()) == [0, 0, 0]
+    qasm = stabilizer_project.circuit_to_qasm(gates, 3)
+    assert qasm.startswith('OPENQASM 2.0;') and 'cz q[0],q[1];' in qasm
+    circuit = stabilizer_project.circuit_to_qiskit(gates, 3)
+    assert circuit.size() == len(gates)
+
+def test_circuit_builder_read_only():
+    for packed in [False, True]:
+        state = stabilizer_project.Stabilizer(3, 'ZZI,-IZI,-IIZ', packed=packed)
+        destabs = state.destabilizers()
+        gates = state.circuit_builder(output='gates')
+        assert state.stabilizers() == ['ZZI', '-IZI', '-IIZ']
+        assert state.destabilizers() == destabs
+        built = stabilizer_project.Stabilizer(3)
+        built.simulate(gates)
+        assert built.measurement(state.stabilizers()) == [0, 0, 0]
+
+def test_depth_mode_synthesis():
+    state = stabilizer_project.Stabilizer(edgelist=[[i,(i+1)%8] for i in range(8)])
+    state.clifford('S',2)
+    state.clifford('X',5)
+    standard = stabilizer_project.circuit_stats(state.circuit_builder(output='gates'))
+    gates = state.circuit_builder(output='gates', mode='depth')
+    layered = stabilizer_project.circuit_stats(gates)
+    assert layered['cz'] == standard['cz'] == 8
+    assert layered['depth'] == 4 < standard['depth']
+    built = stabilizer_project.Stabilizer(8)
+    built.simulate(gates)
+    assert built.measurement(state.stabilizers()) == [0]*8
+    # Here the greedy layering alone is a layer deeper than the standard order
+    state = stabilizer_project.Stabilizer(5, 'YZZYI,ZXIII,-IIZII,-ZIIZI,-IIIIZ')
+    gates = state.circuit_builder(output='gates', mode='depth')
+    assert stabilizer_project.circuit_stats(gates)['depth'] <= stabilizer_project.circuit_stats(state.circuit_builder(output='gates'))['depth']
+    built = stabilizer_project.Stabilizer(5)
+    built.simulate(gates)
+    assert built.measurement(state.stabilizers()) == [0]*5
+
+def test_graph_mode_synthesis():
+    complete = [[i,j] for i in range(6) for j in range(i+1,6)]
+    states = [stabilizer_project.Stabilizer(edgelist=complete), stabilizer_project.Stabilizer(3, '-XZI,ZYZ,IZX')]
+    # Plain graph states, where a local complementation can cost more gates than the edges it removes
+    states += [stabilizer_project.Stabilizer(edgelist=edges) for edges in [[[0,1],[1,2],[2,0]], [[0,2],[1,3],[1,4],[3,4]], [[i,(i+1)%5] for i in range(5)]]]
+    for state in states:
+        gates = state.circuit_builder(output='gates', mode='graph')
+        stats = stabilizer_project.circuit_stats(gates)
+        assert stats['size'] <= stabilizer_project.circuit_stats(state.circuit_builder(output='gates'))['size']
+        built = stabilizer_project.Stabilizer(state.size)
+        built.simulate(gates)
+        assert built.measurement(state.stabilizers()) == [0]*state.size
+    # Local complementation turns the complete graph into a star
+    gates = stabilizer_project.Stabilizer(edgelist=complete).circuit_builder(output='gates', mode='graph')
+    assert stabilizer_project.circuit_stats(gates)['cz'] == 5
+
+def test_circuit_cache():
+    stabilizer_project.clear_circuit_cache()
+    state = stabilizer_project.Stabilizer(3, '-XZI,ZYZ,IZX')
+    first = state.circuit_builder(output='gates')
+    same = stabilizer_project.Stabilizer(3, 'ZYZ,-XZI,IZX', packed=True)
+    same.row_add(0,2)
+    assert np.array_equal(same.circuit_builder(output='gates'), first)
+    stabilizer_project.Stabilizer(3, 'XZI,ZYZ,IZX').circuit_builder(output='gates')
+    info = stabilizer_project.circuit_cache_info()
+    assert (info['hits'], info['misses'], info['currsize']) == (1, 2, 2)
+    stabilizer_project.set_circuit_cache_size(1)
+    assert stabilizer_project.circuit_cache_info()['currsize'] == 1
+    stabilizer_project.set_circuit_cache_size(256)
+    stabilizer_project.clear_circuit_cache()
+
+def test_canonical_form_and_equality():
+    state = stabilizer_project.Stabilizer(3, '-XZI,ZYZ,IZX')
+    other = stabilizer_project.Stabilizer(3, 'IZX,ZYZ,-XZI', packed=True)
+    other.row_add(2,1)
+    other.row_add(0,2)
+    assert other.stabilizers() != state.stabilizers()
+    assert state == other and hash(state) == hash(other)
+    assert state.canonical().stabilizers() == other.canonical().stabilizers()
+    assert len({state, other, stabilizer_project.Stabilizer(3, 'XZI,ZYZ,IZX')}) == 2
+    other.clifford('Z',0)
+    assert state != other
+
+def test_rref_bits():
+    for packed in [False, True]:
+        state = stabilizer_project.Stabilizer(edgelist=[[0,1],[1,2],[2,3],[3,0]], packed=packed)
+        leftmost = stabilizer_project.rref(state)
+        assert state.stabilizers() == ['XZIZ', 'ZXZI', 'IZXZ', 'IXIX']
+        assert leftmost.tolist() == [0, 0, 1, 1]
+        assert state == stabilizer_project.Stabilizer(edgelist=[[0,1],[1,2],[2,3],[3,0]])
+
+def test_heightfunction_array():
+    line = stabilizer_project.Stabilizer(edgelist=[[0,1],[1,2],[2,3]])
+    height = stabilizer_project.heightfunction(line)
+    assert isinstance(height, np.ndarray)
+    assert height.tolist() == [0, 1, 1, 1, 0]
+    ring = stabilizer_project.Stabilizer(edgelist=[[i,(i+1)%6] for i in range(6)])
+    assert stabilizer_project.heightfunction(ring).tolist() == [0, 1, 2, 2, 2, 1, 0]
+    assert stabilizer_project.num_emitters(ring) == 2
+
+def test_rref_from_start_column():
+    for packed in [False, True]:
+        states = []
+        for _ in range(2):
+            state = stabilizer_project.Stabilizer(edgelist=[[i,(i+1)%6] for i in range(6)], packed=packed)
+            stabilizer_project.rref(state)
+            state.clifford('CNOT',5,3)
+            state.clifford('S',4)
+            state.row_add(5,4)
+            states.append(state)
+        assert stabilizer_project.rref(states[0],3).tolist() == stabilizer_project.rref(states[1]).tolist()
+        assert states[0].stabilizers() == states[1].stabilizers()
+
+def test_solver_protocol_array():
+    line = stabilizer_project.Stabilizer(edgelist=[[0,1],[1,2]])
+    protocol = stabilizer_project.photonic_circuit_solver(line)
+    assert protocol.dtype == stabilizer_project.PROTOCOL_DTYPE
+    assert [stabilizer_project.PROTOCOL_OPS[op] for op in protocol['op']] == ['emit','h','emit','emit','h','h','measure']
+    assert protocol['photon'].tolist() == [0,0,1,2,-1,2,2]
+    assert protocol['step'].tolist() == [0,1,1,2,3,3,4]
+    ring = stabilizer_project.Stabilizer(edgelist=[[i,(i+1)%6] for i in range(6)])
+    stats = stabilizer_project.protocol_stats(stabilizer_project.photonic_circuit_solver(ring))
+    assert stats['emitters'] == 2 and stats['photons'] == 6 and stats['emit'] == 6
+    assert stats['emitter_cnots'] == 2 and stats['measurements'] == 2
+
+def test_solve_many():
+    states = [stabilizer_project.Stabilizer(edgelist=[[i,(i+1)%n] for i in range(n)], packed=(n%2==0)) for n in range(3,8)]
+    expected = [stabilizer_project.photonic_circuit_solver(state.clone()) for state in states]
+    before = [state.stabilizers() for state in states]
+    for workers in [1, 2]:
+        results = dict(stabilizer_project.solve_many(iter(states), workers=workers))
+        assert sorted(results) == list(range(len(states)))
+        for i in range(len(states)):
+            assert np.array_equal(results[i], expected[i])
+    assert [state.stabilizers() for state in states] == before
+
+def test_optimize_ordering():
+    order = [0, 5, 2, 7, 4, 1, 6, 3]
+    line = stabilizer_project.Stabilizer(edgelist=[[order[i],order[i+1]] for i in range(7)])
+    assert stabilizer_project.num_emitters(line.clone()) == 4
+    for method in ['greedy', 'swaps', 'anneal']:
+        best, height = stabilizer_project.optimize_ordering(line, method=method, seed=1)
+        assert sorted(best.tolist()) == list(range(8))
+        assert height.tolist() == stabilizer_project.heightfunction(stabilizer_project.permute_qubits(line, best)).tolist()
+        assert height.max() < 4
+    best, height = stabilizer_project.optimize_ordering(line, method='greedy')
+    assert height.max() == 1
+    with pytest.raises(ValueError):
+        stabilizer_project.permute_qubits(line, [0, 0, 1, 2, 3, 4, 5, 6])
+
+def test_solver_without_stabilizer_at_photon():
+    # No stabilizer starts at some photon here, so the solver falls back on the last one it used
+    states = [stabilizer_project.Stabilizer(7,'-YYZYXYI,-ZYZZZZX,IYXXXYI,-ZIYYXYI,XXYXIYZ,XZYXXYX,ZIZZIYY'),
+              stabilizer_project.Stabilizer(edgelist=[[0,1],[3,4]])]
+    for state, size in zip(states, [35, 16]):
+        stats = stabilizer_project.protocol_stats(stabilizer_project.photonic_circuit_solver(state))
+        assert stats['emit'] == state.size and stats['size'] == size